@@ -0,0 +1,772 @@
+#!/usr/bin/env python
+
+# Benchmarks for the Drupal updater.
+# Copyright (C) 2012  Hoppinger BV
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+#
+
+import os, sys, re, socket, argparse, timeit, hashlib, random, shutil, tempfile, difflib, time, threading, tarfile, gzip, urllib
+import xml.dom.minidom as minidom, BaseHTTPServer, SimpleHTTPServer, SocketServer
+
+from StringIO import StringIO
+
+import updater
+
+# Print the best time of a benchmark, per run, in milliseconds
+def report(label, times, number):
+    print '%-45s %10.2f ms' % (label, min(times) / number * 1000)
+
+# Construct a release history document that looks like the one of Drupal core:
+# a few hundred releases, newest first, each with its files and terms.
+def make_release_history(project, core, count):
+    major = core.split('.')[0]
+    releases = []
+    for i in range(count, 0, -1):
+        version = '%s.%d' % (major, i)
+        md5 = hashlib.md5(version).hexdigest()
+        release_type = 'Security update' if i % 3 == 0 else 'Bug fixes'
+        releases.append('''  <release>
+    <name>%(project)s %(version)s</name>
+    <version>%(version)s</version>
+    <tag>%(version)s</tag>
+    <version_major>%(major)s</version_major>
+    <version_patch>%(patch)d</version_patch>
+    <status>published</status>
+    <release_link>http://drupal.org/drupal-%(version)s</release_link>
+    <download_link>http://ftp.drupal.org/files/projects/%(project)s-%(version)s.tar.gz</download_link>
+    <date>%(date)d</date>
+    <mdhash>%(md5)s</mdhash>
+    <filesize>3190000</filesize>
+    <files>
+      <file><url>http://ftp.drupal.org/files/projects/%(project)s-%(version)s.tar.gz</url><archive_type>tar.gz</archive_type><md5>%(md5)s</md5><size>3190000</size><filedate>%(date)d</filedate></file>
+      <file><url>http://ftp.drupal.org/files/projects/%(project)s-%(version)s.zip</url><archive_type>zip</archive_type><md5>%(md5)s</md5><size>3600000</size><filedate>%(date)d</filedate></file>
+    </files>
+    <terms>
+      <term><name>Release type</name><value>%(release_type)s</value></term>
+      <term><name>Release type</name><value>New features</value></term>
+    </terms>
+  </release>
+''' % {'project': project, 'version': version, 'major': major, 'patch': i, 'md5': md5,
+       'date': 1300000000 + i * 86400, 'release_type': release_type})
+
+    return '''<?xml version="1.0" encoding="utf-8"?>
+<project xmlns:dc="http://purl.org/dc/elements/1.1/">
+<title>Drupal core</title>
+<short_name>%s</short_name>
+<api_version>%s</api_version>
+<recommended_major>%s</recommended_major>
+<supported_majors>%s</supported_majors>
+<default_major>%s</default_major>
+<project_status>published</project_status>
+<link>http://drupal.org/project/%s</link>
+<releases>
+%s</releases>
+</project>
+''' % (project, core, major, major, major, project, ''.join(releases))
+
+# The minidom based parser the updater used before, for comparison
+def parse_release_history_minidom(xml):
+    def get_text(node, tag_name):
+        elements = node.getElementsByTagName(tag_name)
+        if not elements:
+            return ''
+        return ''.join([ child.data for child in elements[0].childNodes if child.nodeType == child.TEXT_NODE ])
+
+    releases = []
+    dom = minidom.parseString(xml)
+    for release in dom.getElementsByTagName('release'):
+        releases.append({
+            'version': get_text(release, 'version'),
+            'version_major': get_text(release, 'version_major'),
+            'release_types': [ get_text(term, 'value') for term in release.getElementsByTagName('term') if get_text(term, 'name') == updater.release_type_key ],
+            'md5': get_text(release, 'mdhash'),
+            'filesize': get_text(release, 'filesize'),
+        })
+    return releases
+
+# Compare parsing a release history with minidom and with the streaming parser.
+# A recorded document can be given with --file, for example
+#   curl -o drupal-7.x.xml http://updates.drupal.org/release-history/drupal/7.x
+def benchmark_release_history(options):
+    if options.file:
+        with open(options.file) as fp:
+            xml = fp.read()
+    else:
+        xml = make_release_history('drupal', '7.x', options.releases)
+
+    releases = list(updater.iter_release_history(StringIO(xml)))
+    installed = options.installed or releases[min(len(releases), 20) - 1]['version']
+    print '%d releases, %d bytes, installed version %s' % (len(releases), len(xml), installed)
+
+    def stop_at_installed():
+        for release in updater.iter_release_history(StringIO(xml)):
+            if release['version'] == installed:
+                break
+
+    report('minidom, whole document', timeit.repeat(lambda: parse_release_history_minidom(xml), number=options.number, repeat=options.repeat), options.number)
+    report('iterparse, whole document', timeit.repeat(lambda: list(updater.iter_release_history(StringIO(xml))), number=options.number, repeat=options.repeat), options.number)
+    report('iterparse, up to the installed version', timeit.repeat(stop_at_installed, number=options.number, repeat=options.repeat), options.number)
+
+# Generate the contents of a PHP-like source file
+def make_source(rng, lines):
+    result = ['<?php\n', '\n']
+    for i in range(lines):
+        if i % 20 == 0:
+            result.append('/**\n * Implements hook_%d().\n */\nfunction example_%d_%d($node, $op = NULL) {\n' % (i, rng.randint(0, 10**6), i))
+        elif i % 20 == 19:
+            result.append('}\n\n')
+        else:
+            result.append('  $result[%d] = check_plain($node->field_%d[%d]);\n' % (i, rng.randint(0, 50), rng.randint(0, 9)))
+    return ''.join(result)
+
+# Write a tree of text files that looks like the files of Drupal core, spread
+# over nested directories, and return the relative paths of the files
+def make_source_tree(path, count, rng):
+    files = []
+    for i in range(count):
+        directory = os.path.join('modules', 'module%d' % (i % 60), 'includes' if i % 3 else '')
+        f = os.path.join(directory, 'file%d.%s' % (i, ['module', 'inc', 'php', 'js', 'css'][i % 5]))
+        if not os.path.isdir(os.path.join(path, directory)):
+            os.makedirs(os.path.join(path, directory))
+        with open(os.path.join(path, f), 'w') as fp:
+            fp.write(make_source(rng, rng.randint(20, 600)))
+        files.append(f)
+    return files
+
+# Hack a fraction of the files of a tree, like a patched Drupal installation
+def hack_source_tree(path, files, density, rng):
+    hacked = rng.sample(files, int(len(files) * density))
+    for f in hacked:
+        with open(os.path.join(path, f)) as fp:
+            lines = fp.readlines()
+        position = rng.randint(2, len(lines))
+        lines[position:position] = ['  // hacked\n', '  $result[] = TRUE;\n']
+        with open(os.path.join(path, f), 'w') as fp:
+            fp.writelines(lines)
+    return hacked
+
+# Compare constructing the patches of a tree in-process and with diff. Real
+# trees can be given with --original and --modified, for example an extracted
+# drupal.org release and a Drupal installation.
+def benchmark_diff(options):
+    tmp = tempfile.mkdtemp()
+    try:
+        if options.original and options.modified:
+            original, modified = options.original, options.modified
+            files = []
+            for root, dirs, filenames in os.walk(original):
+                files.extend([ os.path.relpath(os.path.join(root, f), original) for f in filenames ])
+        else:
+            rng = random.Random(options.seed)
+            original = os.path.join(tmp, 'original')
+            modified = os.path.join(tmp, 'modified')
+            files = make_source_tree(original, options.files, rng)
+            shutil.copytree(original, modified)
+            hack_source_tree(modified, files, options.density, rng)
+        print '%d files' % len(files)
+
+        def construct_patches():
+            return len([ f for f in files if updater.diff_files(f, original, modified) ])
+
+        for backend in updater.diff_backends:
+            updater.diff_backend = backend
+            print '%s backend: %d patches' % (backend, construct_patches())
+            report('%s backend' % backend, timeit.repeat(construct_patches, number=1, repeat=options.repeat), 1)
+    finally:
+        shutil.rmtree(tmp)
+
+# Write a Drupal installation with `count` contrib modules, each with an info
+# file, some code and a submodule, and return the path of its root
+def make_module_tree(path, count, rng):
+    def write(f, data):
+        if not os.path.isdir(os.path.dirname(os.path.join(path, f))):
+            os.makedirs(os.path.dirname(os.path.join(path, f)))
+        with open(os.path.join(path, f), 'w') as fp:
+            fp.write(data)
+
+    def info(name, project, version):
+        lines = ['name = %s' % name, 'description = "Synthetic module %s"' % name, 'core = 7.x', 'package = Benchmark']
+        lines.extend([ 'files[] = includes/%s_%d.inc' % (name, i) for i in range(rng.randint(2, 20)) ])
+        if project:
+            lines.extend(['', '; Information added by drupal.org packaging script', 'version = "%s"' % version, 'core = "7.x"', 'project = "%s"' % project, 'datestamp = "1300000000"'])
+        return '\n'.join(lines) + '\n'
+
+    write('modules/system/system.info', info('system', 'drupal', '7.10'))
+    for i in range(count):
+        name = 'module%d' % i
+        directory = os.path.join('sites/all/modules/contrib', name)
+        write(os.path.join(directory, name + '.info'), info(name, name, '7.x-1.%d' % (i % 10)))
+        write(os.path.join(directory, name + '.module'), make_source(rng, 20))
+        write(os.path.join(directory, 'includes', name + '.inc'), make_source(rng, 20))
+        write(os.path.join(directory, name + '_sub', name + '_sub.info'), info(name + '_sub', name, '7.x-1.%d' % (i % 10)))
+        if i % 10 == 0:
+            write(os.path.join(directory, 'node_modules', 'dependency', 'index.js'), '// javascript\n')
+    return path
+
+# The way the updater used to find packages: os.walk() over sites/all/modules
+# and reading every info file three times, for comparison
+def find_packages_walk(drupal_root):
+    def get_package(info_file):
+        pkg = {}
+        with open(info_file) as f:
+            for regex, key in [(updater.package_re, 'name'), (updater.version_re, 'version'), (updater.core_re, 'core')]:
+                f.seek(0)
+                for line in f.readlines():
+                    m = regex.match(line)
+                    if m:
+                        pkg[key] = m.group(1)
+                if not pkg.has_key(key):
+                    return False
+        return pkg
+
+    packages = [ get_package(os.path.join(drupal_root, 'modules/system/system.info')) ]
+    for root, dirs, files in os.walk(os.path.join(drupal_root, 'sites/all/modules')):
+        if '.svn' in dirs:
+            dirs.remove('.svn')
+        for f in files:
+            if updater.info_re.match(f):
+                pkg = get_package(os.path.join(root, f))
+                if pkg:
+                    packages.append(pkg)
+                    dirs[:] = []
+                    break
+    return packages
+
+# Compare finding the packages of a Drupal installation with thousands of
+# modules, with and without the index of info files
+def benchmark_discovery(options):
+    tmp = tempfile.mkdtemp()
+    try:
+        drupal_root = options.root or make_module_tree(os.path.join(tmp, 'drupal'), options.modules, random.Random(options.seed))
+        index_file = os.path.join(tmp, 'cache', 'info-index.json')
+
+        def without_index():
+            updater.cache_dir = None
+            return updater.find_packages(drupal_root)
+
+        def cold_index():
+            updater.cache_dir = os.path.join(tmp, 'cache')
+            if os.path.isfile(index_file):
+                os.remove(index_file)
+            return updater.find_packages(drupal_root)
+
+        def warm_index():
+            updater.cache_dir = os.path.join(tmp, 'cache')
+            return updater.find_packages(drupal_root)
+
+        print '%d packages, scandir %s' % (len(without_index()), 'available' if updater.scandir else 'not available')
+        report('os.walk, three passes per info file', timeit.repeat(lambda: find_packages_walk(drupal_root), number=1, repeat=options.repeat), 1)
+        report('single pass, no index', timeit.repeat(without_index, number=1, repeat=options.repeat), 1)
+        report('single pass, building the index', timeit.repeat(cold_index, number=1, repeat=options.repeat), 1)
+        warm_index()
+        report('single pass, unchanged index', timeit.repeat(warm_index, number=1, repeat=options.repeat), 1)
+    finally:
+        shutil.rmtree(tmp)
+
+# The way the updater used to classify files, with difflib, for comparison
+def compare_filelists_difflib(downloaded_filelist, original_filelist):
+    added_files = []
+    removed_files = []
+    matching_files = []
+    d = difflib.SequenceMatcher(None, downloaded_filelist, original_filelist)
+    for tag, i1, i2, j1, j2 in d.get_opcodes():
+        if tag == 'insert':
+            added_files.extend(original_filelist[j1:j2])
+        elif tag == 'delete':
+            removed_files.extend(downloaded_filelist[i1:i2])
+        elif tag == 'replace':
+            added_files.extend(original_filelist[j1:j2])
+            removed_files.extend(downloaded_filelist[i1:i2])
+        elif tag == 'equal':
+            matching_files.extend(downloaded_filelist[i1:i2])
+    return added_files, removed_files, matching_files
+
+# Compare classifying the files of two core-sized trees into added, removed and
+# matching files with difflib and with a merge of the sorted lists
+def benchmark_filelist(options):
+    rng = random.Random(options.seed)
+    paths = set()
+    for i in range(options.files):
+        parts = [ 'dir%d' % rng.randint(0, 30) for depth in range(rng.randint(0, 4)) ]
+        for depth in range(len(parts)):
+            paths.add('/'.join(parts[:depth + 1]))
+        paths.add('/'.join(parts + ['file%d.%s' % (i, ['php', 'inc', 'module', 'js'][i % 4])]))
+    paths = sorted(paths)
+
+    downloaded = [ p for p in paths if rng.random() > options.changes ]
+    original = [ p for p in paths if rng.random() > options.changes ]
+    downloaded_entries = sorted([ updater.FileEntry(p, 'file', 0, 0) for p in downloaded ], key=lambda entry: updater.path_sort_key(entry.path))
+    original_entries = sorted([ updater.FileEntry(p, 'file', 0, 0) for p in original ], key=lambda entry: updater.path_sort_key(entry.path))
+
+    expected = [ sorted(l) for l in compare_filelists_difflib(downloaded, original) ]
+    if [ sorted(l) for l in updater.compare_trees(downloaded_entries, original_entries) ] != expected:
+        print 'Results differ!'
+    print '%d and %d paths, %d matching' % (len(downloaded), len(original), len(expected[2]))
+
+    report('difflib.SequenceMatcher', timeit.repeat(lambda: compare_filelists_difflib(downloaded, original), number=options.number, repeat=options.repeat), options.number)
+    report('merge of sorted lists', timeit.repeat(lambda: updater.compare_trees(downloaded_entries, original_entries), number=options.number, repeat=options.repeat), options.number)
+
+# Generate the files of a project: text files that look like Drupal code, and a
+# fraction of binary files. Returns a dict that maps paths to contents.
+def make_project_files(rng, count, binary):
+    files = {}
+    for i in range(count):
+        directory = os.path.join('modules', 'module%d' % (i % 60), 'includes' if i % 3 else '') if count > 100 else ('includes' if i % 3 else '')
+        if rng.random() < binary:
+            files[os.path.join('images', 'image%d.png' % i)] = '\x89PNG\r\n\x1a\n\0' + ''.join([ chr(rng.randint(0, 255)) for j in range(rng.randint(256, 4096)) ])
+        else:
+            files[os.path.join(directory, 'file%d.%s' % (i, ['module', 'inc', 'php', 'js', 'css'][i % 5]))] = make_source(rng, rng.randint(20, 600))
+    return files
+
+# Generate the next release of a project: a fraction of the text files gets a
+# new function at the end
+def make_next_release(rng, files, changes):
+    result = dict(files)
+    for f in sorted(files):
+        if '\0' not in files[f] and rng.random() < changes:
+            result[f] = files[f] + 'function update_%d() {\n  return TRUE;\n}\n' % rng.randint(0, 10**6)
+    return result
+
+# Hack a fraction of the text and binary files of a project, like a patched
+# Drupal installation
+def hack_project_files(rng, files, density):
+    result = dict(files)
+    for f in sorted(files):
+        if f.endswith('.info') or rng.random() >= density:
+            continue
+        if '\0' in files[f]:
+            result[f] = files[f][:-16] + ''.join([ chr(rng.randint(0, 255)) for j in range(16) ])
+        else:
+            lines = files[f].splitlines(True)
+            position = rng.randint(2, len(lines) - 1)
+            lines[position:position] = ['  // hacked\n', '  $result[] = TRUE;\n']
+            result[f] = ''.join(lines)
+    return result
+
+# Write the files of a release to a tar.gz file the way drupal.org packages them,
+# in a directory of their own. Returns the md5 hash and the size of the tarball.
+def write_tarball(filename, directory, files):
+    with open(filename, 'wb') as fp:
+        gz = gzip.GzipFile(fileobj=fp, mode='wb', mtime=0)
+        tar = tarfile.open(fileobj=gz, mode='w')
+        directories = set()
+        for f in sorted(files):
+            parent = os.path.dirname(f)
+            while parent and parent not in directories:
+                directories.add(parent)
+                parent = os.path.dirname(parent)
+        for d in sorted(directories | set([''])):
+            info = tarfile.TarInfo(os.path.join(directory, d).rstrip('/'))
+            info.type = tarfile.DIRTYPE
+            info.mode = 0755
+            tar.addfile(info)
+        for f in sorted(files):
+            info = tarfile.TarInfo(os.path.join(directory, f))
+            info.size = len(files[f])
+            info.mode = 0644
+            info.mtime = 1300000000
+            tar.addfile(info, StringIO(files[f]))
+        tar.close()
+        gz.close()
+    with open(filename, 'rb') as fp:
+        data = fp.read()
+    return hashlib.md5(data).hexdigest(), len(data)
+
+# Construct the release history of a project from a list of (version, md5, size)
+# tuples, newest first. The newest release is a security update.
+def make_project_release_history(project, core, releases):
+    major = releases[0][0].split('-')[-1].split('.')[0]
+    items = []
+    for i, (version, md5, size) in enumerate(releases):
+        items.append('''  <release>
+    <name>%(project)s %(version)s</name>
+    <version>%(version)s</version>
+    <version_major>%(major)s</version_major>
+    <status>published</status>
+    <mdhash>%(md5)s</mdhash>
+    <filesize>%(size)d</filesize>
+    <terms>
+      <term><name>Release type</name><value>%(release_type)s</value></term>
+    </terms>
+  </release>
+''' % {'project': project, 'version': version, 'major': major, 'md5': md5, 'size': size,
+       'release_type': 'Security update' if i == 0 else 'Bug fixes'})
+    return '''<?xml version="1.0" encoding="utf-8"?>
+<project xmlns:dc="http://purl.org/dc/elements/1.1/">
+<short_name>%s</short_name>
+<api_version>%s</api_version>
+<releases>
+%s</releases>
+</project>
+''' % (project, core, ''.join(items))
+
+# Write a release server and a hacked Drupal installation: Drupal core with
+# `core_files` files and `modules` contrib modules with `module_files` files,
+# each with an installed and a newer release. The server directory has the
+# release histories in release-history/ and the tarballs in files/. Returns the
+# number of packages and the number of hacked files.
+def make_update_fixture(server, site, rng, options):
+    projects = [ ('drupal', '7.10', '7.12', options.core_files) ]
+    projects.extend([ ('module%d' % i, '7.x-1.0', '7.x-1.1', options.module_files) for i in range(options.modules) ])
+
+    hacked = 0
+    for name, installed, newest, count in projects:
+        if name == 'drupal':
+            info_path, location = 'modules/system/system.info', site
+        else:
+            info_path, location = name + '.info', os.path.join(site, 'sites/all/modules/contrib', name)
+
+        old = make_project_files(rng, count, options.binary)
+        new = make_next_release(rng, old, options.changes)
+        old[info_path] = 'name = %s\ncore = 7.x\n\nversion = "%s"\ncore = "7.x"\nproject = "%s"\n' % (name, installed, name)
+        new[info_path] = 'name = %s\ncore = 7.x\n\nversion = "%s"\ncore = "7.x"\nproject = "%s"\n' % (name, newest, name)
+
+        releases = []
+        for version, files in [ (newest, new), (installed, old) ]:
+            directory = name + '-' + version if name == 'drupal' else name
+            filename = os.path.join(server, 'files', '%s-%s.tar.gz' % (name, version))
+            updater.ensure_dir(os.path.dirname(filename))
+            md5, size = write_tarball(filename, directory, files)
+            releases.append((version, md5, size))
+        updater.write_file_atomic(os.path.join(server, 'release-history', name, '7.x'), make_project_release_history(name, '7.x', releases))
+
+        installed_files = hack_project_files(rng, old, options.density)
+        hacked += len([ f for f in old if installed_files[f] != old[f] ])
+        for f in installed_files:
+            updater.ensure_dir(os.path.dirname(os.path.join(location, f)))
+            with open(os.path.join(location, f), 'wb') as fp:
+                fp.write(installed_files[f])
+    return len(projects), hacked
+
+# Local stand-in for drupal.org, serving a directory over HTTP from a thread.
+# Connections are kept alive, conditional requests with If-Modified-Since are
+# answered, and Range requests are supported, unless `ranges` is turned off. A
+# `flaky` fraction of the responses breaks off halfway, like a dropped
+# connection, and so do the next `breaks` responses.
+class ReleaseServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+
+    # clients that give up on a connection are part of the tests
+    def handle_error(self, request, client_address):
+        if not isinstance(sys.exc_info()[1], socket.error):
+            BaseHTTPServer.HTTPServer.handle_error(self, request, client_address)
+
+class ReleaseRequestHandler(SimpleHTTPServer.SimpleHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def translate_path(self, path):
+        return os.path.join(self.server.root, urllib.unquote(path.split('?')[0]).lstrip('/'))
+
+    def do_GET(self):
+        path = self.translate_path(self.path)
+        if not os.path.isfile(path):
+            self.send_error(404)
+            return
+        with open(path, 'rb') as fp:
+            data = fp.read()
+
+        last_modified = self.date_time_string(int(os.path.getmtime(path)))
+        if self.headers.getheader('If-Modified-Since') == last_modified:
+            self.server.requests += 1
+            self.send_response(304)
+            self.send_header('Last-Modified', last_modified)
+            self.end_headers()
+            return
+
+        start = 0
+        match = re.match(r'^bytes=(\d+)-$', self.headers.getheader('Range') or '')
+        if match and int(match.group(1)) < len(data) and self.server.ranges:
+            start = int(match.group(1))
+            self.send_response(206)
+            self.send_header('Content-Range', 'bytes %d-%d/%d' % (start, len(data) - 1, len(data)))
+        else:
+            self.send_response(200)
+        self.send_header('Content-Length', str(len(data) - start))
+        self.send_header('Accept-Ranges', 'bytes')
+        self.send_header('Last-Modified', last_modified)
+        self.end_headers()
+
+        self.server.requests += 1
+        if self.server.breaks or self.server.rng.random() < self.server.flaky:
+            self.server.breaks = max(self.server.breaks - 1, 0)
+            self.wfile.write(data[start:start + (len(data) - start) / 2])
+            self.close_connection = 1
+        else:
+            self.wfile.write(data[start:])
+
+    def log_message(self, format, *args):
+        pass
+
+# Serve the directory root on a free port. Returns the server and its url.
+def start_release_server(root, flaky=0.0, seed=1):
+    server = ReleaseServer(('127.0.0.1', 0), ReleaseRequestHandler)
+    server.root = root
+    server.flaky = flaky
+    server.ranges = True
+    server.breaks = 0
+    server.rng = random.Random(seed)
+    server.requests = 0
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return server, 'http://127.0.0.1:%d/' % server.server_address[1]
+
+# Update a copy of a Drupal installation the way updater.py does, without the
+# questions and the output. Returns the measurements of the stages and the
+# packages that were not updated cleanly.
+def update_installation(drupal_root, patches_path, workers, concurrency):
+    stdout = sys.stdout
+    sys.stdout = StringIO()
+    updater.start_instrumentation()
+    try:
+        with updater.stage('discovery'):
+            packages = updater.find_packages(drupal_root)
+        outdated = updater.prefetch_best_versions(packages, concurrency)
+        updater.update_packages(outdated, patches_path, workers)
+    finally:
+        measured = updater.stop_instrumentation()
+        sys.stdout = stdout
+    failed = [ package for package in outdated if package.get('status') != 'updated' or package['patch_failures'] ]
+    return measured, packages, failed
+
+# Time complete updates of a generated Drupal installation against a local
+# release server, serially and with multiple workers, and the stages within.
+# Without the cache first, and then with a cache that the first run fills and
+# the second run revalidates, the default of the updater. The cache is in a
+# directory with a non-ASCII name on purpose. Exits with status 1 when a
+# package was not updated cleanly.
+def benchmark_update(options):
+    tmp = tempfile.mkdtemp()
+    server = None
+    unclean = False
+    try:
+        site = os.path.join(tmp, 'site')
+        packages, hacked = make_update_fixture(os.path.join(tmp, 'server'), site, random.Random(options.seed), options)
+        server, url = start_release_server(os.path.join(tmp, 'server'), options.flaky, options.seed)
+        updater.http_backoff = 0.01
+        updater.drupal_release_info_base = url + 'release-history/'
+        updater.drupal_download_base = url + 'files/'
+        updater.release_history_ttl = 0
+        updater.staged = options.staged
+        print '%d packages, %d hacked files, %s update' % (packages, hacked, 'staged' if options.staged else 'in-place')
+
+        work = os.path.join(tmp, 'work')
+        patches_path = os.path.join(tmp, 'patches')
+        def update(workers):
+            for path in [ work, patches_path, os.path.join(tmp, '.drupal-updater-work') ]:
+                if os.path.isdir(path):
+                    shutil.rmtree(path)
+            shutil.copytree(site, work)
+            os.mkdir(patches_path)
+
+            start = time.time()
+            measured, found, failed = update_installation(work, patches_path, workers, options.concurrency)
+            elapsed = time.time() - start
+            if failed:
+                print '%d packages were not updated cleanly: %s' % (len(failed), ', '.join([ package['name'] for package in failed ]))
+            return elapsed, measured, failed
+
+        runs = []
+        updater.cache_dir = None
+        for workers in options.workers:
+            best = None
+            for i in range(options.repeat):
+                elapsed, measured, failed = update(workers)
+                unclean = unclean or bool(failed)
+                if not best or elapsed < best[0]:
+                    best = (elapsed, measured)
+            runs.append(('%d workers' % workers, best[0], best[1]))
+
+        updater.cache_dir = os.path.join(tmp, 'cache-\xc3\xbc')
+        for label in ['cold cache', 'warm cache']:
+            elapsed, measured, failed = update(options.workers[-1])
+            unclean = unclean or bool(failed)
+            runs.append(('%s, %d workers' % (label, options.workers[-1]), elapsed, measured))
+
+        for label, elapsed, measured in runs:
+            report('end-to-end, %s' % label, [elapsed], 1)
+            for name in ['discovery', 'release-history', 'update', 'compare', 'extract', 'download', 'filelist', 'classify', 'diff', 'copy', 'patch']:
+                if measured['stages'].has_key(name):
+                    report('  %s, %d times' % (name, measured['stages'][name]['count']), [measured['stages'][name]['time']], 1)
+            print '  %(bytes_downloaded)d bytes downloaded, %(http_retries)d retries, %(bytes_read)d bytes read, %(subprocesses)d subprocesses, %(files_touched)d files touched' % dict([ (key, measured['counters'].get(key, 0)) for key in ['bytes_downloaded', 'http_retries', 'bytes_read', 'subprocesses', 'files_touched'] ])
+    finally:
+        updater.cache_dir = None
+        updater.close_http_connections()
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmp)
+
+    if unclean:
+        sys.exit(1)
+
+# Download files from a flaky local release server with the HTTP layer of the
+# updater, and check that every transfer is reassembled byte for byte from the
+# parts it was resumed with. A transfer that breaks off while the server
+# ignores ranges has to fail instead of splicing two bodies together. Exits
+# with status 1 when a check fails.
+def benchmark_download(options):
+    tmp = tempfile.mkdtemp()
+    server = None
+    rng = random.Random(options.seed)
+    failures = []
+    try:
+        files = {}
+        for i in range(options.files):
+            name = 'file-%d.bin' % i
+            size = rng.randint(1, options.size)
+            files[name] = ('%0*x' % (size * 2, rng.getrandbits(size * 8))).decode('hex')
+            with open(os.path.join(tmp, name), 'wb') as fp:
+                fp.write(files[name])
+        server, url = start_release_server(tmp, options.flaky, options.seed)
+        updater.http_backoff = 0.001
+        updater.http_retries = 10
+
+        def download():
+            for name in sorted(files):
+                try:
+                    with updater.urlopen(url + name) as response:
+                        data = response.read()
+                except IOError as e:
+                    failures.append(str(e))
+                    continue
+                if data != files[name]:
+                    failures.append('%s differs: %d bytes instead of %d' % (name, len(data), len(files[name])))
+
+        updater.start_instrumentation()
+        try:
+            report('download %d files with %d%% breaking off' % (options.files, options.flaky * 100), timeit.repeat(download, number=1, repeat=options.repeat), 1)
+        finally:
+            measured = updater.stop_instrumentation()
+        print '  %d requests, %d retries' % (server.requests, measured['counters'].get('http_retries', 0))
+
+        # a server that ignores ranges can not resume, the transfer has to fail
+        server.ranges = False
+        server.flaky = 0.0
+        server.breaks = 1
+        try:
+            with updater.urlopen(url + sorted(files)[0]) as response:
+                response.read()
+            failures.append('a transfer that could not be resumed did not fail')
+        except IOError:
+            pass
+    finally:
+        updater.close_http_connections()
+        if server:
+            server.shutdown()
+            server.server_close()
+        shutil.rmtree(tmp)
+
+    for failure in failures:
+        print failure
+    if failures:
+        sys.exit(1)
+    print 'All transfers were reassembled byte for byte'
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks for the Drupal updater.')
+    parser.add_argument('--number', type=int, default=10,
+        help='number of runs per measurement (default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=3,
+        help='number of measurements, the best one is reported (default: %(default)s)')
+    subparsers = parser.add_subparsers()
+
+    release_history_parser = subparsers.add_parser('release-history',
+        help='parse a release history document')
+    release_history_parser.add_argument('--file',
+        help='recorded release history document (default: a generated one)')
+    release_history_parser.add_argument('--releases', type=int, default=300,
+        help='number of releases in the generated document (default: %(default)s)')
+    release_history_parser.add_argument('--installed',
+        help='installed version to stop parsing at (default: the 20th release)')
+    release_history_parser.set_defaults(func=benchmark_release_history)
+
+    diff_parser = subparsers.add_parser('diff',
+        help='construct the patches of a tree with every diff backend')
+    diff_parser.add_argument('--original',
+        help='unmodified tree (default: a generated core-sized one)')
+    diff_parser.add_argument('--modified',
+        help='modified version of the tree')
+    diff_parser.add_argument('--files', type=int, default=1500,
+        help='number of files in the generated tree (default: %(default)s)')
+    diff_parser.add_argument('--density', type=float, default=0.05,
+        help='fraction of the generated files that is hacked (default: %(default)s)')
+    diff_parser.add_argument('--seed', type=int, default=1,
+        help='seed for generating the tree (default: %(default)s)')
+    diff_parser.set_defaults(func=benchmark_diff)
+
+    discovery_parser = subparsers.add_parser('discovery',
+        help='find the packages of a Drupal installation')
+    discovery_parser.add_argument('--root',
+        help='Drupal installation (default: a generated one)')
+    discovery_parser.add_argument('--modules', type=int, default=3000,
+        help='number of modules in the generated installation (default: %(default)s)')
+    discovery_parser.add_argument('--seed', type=int, default=1,
+        help='seed for generating the installation (default: %(default)s)')
+    discovery_parser.set_defaults(func=benchmark_discovery)
+
+    filelist_parser = subparsers.add_parser('filelist',
+        help='classify the files of two trees into added, removed and matching files')
+    filelist_parser.add_argument('--files', type=int, default=5000,
+        help='number of files in the trees (default: %(default)s)')
+    filelist_parser.add_argument('--changes', type=float, default=0.02,
+        help='fraction of the paths that is missing from each tree (default: %(default)s)')
+    filelist_parser.add_argument('--seed', type=int, default=1,
+        help='seed for generating the trees (default: %(default)s)')
+    filelist_parser.set_defaults(func=benchmark_filelist)
+
+    update_parser = subparsers.add_parser('update',
+        help='update a generated Drupal installation from a local release server')
+    update_parser.add_argument('--core-files', type=int, default=1500,
+        help='number of files in Drupal core (default: %(default)s)')
+    update_parser.add_argument('--modules', type=int, default=40,
+        help='number of contrib modules (default: %(default)s)')
+    update_parser.add_argument('--module-files', type=int, default=30,
+        help='number of files in every contrib module (default: %(default)s)')
+    update_parser.add_argument('--binary', type=float, default=0.05,
+        help='fraction of the files that is binary (default: %(default)s)')
+    update_parser.add_argument('--density', type=float, default=0.02,
+        help='fraction of the installed files that is hacked (default: %(default)s)')
+    update_parser.add_argument('--changes', type=float, default=0.1,
+        help='fraction of the text files that changes in the newer release (default: %(default)s)')
+    update_parser.add_argument('--workers', type=int, nargs='+', default=[1, 4],
+        help='numbers of workers to compare (default: %(default)s)')
+    update_parser.add_argument('--concurrency', type=int, default=updater.default_concurrency,
+        help='number of release history lookups at the same time (default: %(default)s)')
+    update_parser.add_argument('--staged', action='store_true',
+        help='use staged updates')
+    update_parser.add_argument('--flaky', type=float, default=0.0,
+        help='fraction of the responses of the release server that breaks off halfway (default: %(default)s)')
+    update_parser.add_argument('--seed', type=int, default=1,
+        help='seed for generating the installation (default: %(default)s)')
+    update_parser.set_defaults(func=benchmark_update)
+
+    download_parser = subparsers.add_parser('download',
+        help='download files from a flaky local release server and check that they arrive intact')
+    download_parser.add_argument('--files', type=int, default=20,
+        help='number of files to download (default: %(default)s)')
+    download_parser.add_argument('--size', type=int, default=2**18,
+        help='maximum size of a file in bytes (default: %(default)s)')
+    download_parser.add_argument('--flaky', type=float, default=0.3,
+        help='fraction of the responses that breaks off halfway (default: %(default)s)')
+    download_parser.add_argument('--seed', type=int, default=1,
+        help='seed for generating the files (default: %(default)s)')
+    download_parser.set_defaults(func=benchmark_download)
+
+    options = parser.parse_args()
+    options.func(options)
+
+if __name__ == '__main__':
+    main()
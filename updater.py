@@ -17,39 +17,100 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 #
 
-import os, sys, re, tempfile, shutil, urllib2, subprocess, difflib 
-import xml.dom.minidom as minidom, mimetypes, hashlib
+import os, sys, re, tempfile, shutil, urllib2, subprocess, difflib, httplib, socket, urlparse
+import xml.etree.cElementTree as ElementTree, mimetypes, hashlib, threading, Queue, argparse, time, json, tarfile, zlib, traceback, glob, stat, collections, cProfile
 
-from pprint import pprint as p
-
-# Make sure we are in a Drupal directory
-if not os.path.isfile(os.path.join(os.getcwd(), 'modules/system/system.info')):
-    print "Not in Drupal"
-    sys.exit()
-
-# Get a directory to put the patches in
-print "Enter the path to place patch files is. Relative to working dir."
-patches_path = False
-while not patches_path:
-    patches_path = raw_input("Enter: ")
-patches_path = os.path.join(os.getcwd(), patches_path)
-if not os.path.isdir(patches_path):
+# os.scandir is only available from Python 3.5, and as the scandir package
+try:
+    from os import scandir
+except ImportError:
     try:
-        os.makedirs(patches_path)
-        print "Directory created"
-    except:
-        print "Creating dir failed"
-        sys.exit()
-else:
-    print "Directory already exists. Using it."
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+from pprint import pprint as p
 
 # Information about the downloading
 drupal_download_base = 'http://ftp.drupal.org/files/projects/'
 drupal_download_extension = 'tar.gz'
 drupal_release_info_base = 'http://updates.drupal.org/release-history/'
 
-# Find the packages in the system
-packages = []
+# Number of release-history lookups that are done at the same time
+default_concurrency = 8
+
+# HTTP transfers, see HTTPStream: the seconds before connecting or reading times
+# out, the number of retries of a failed request, the seconds to wait before
+# the first retry, which double for every next one, the number of transfers at
+# the same time, and the bandwidth they share in bytes per second (0 is
+# unlimited). Idle connections are kept in http_pool per host.
+default_http_timeout = 30
+default_http_retries = 4
+default_http_connections = 8
+http_timeout = default_http_timeout
+http_retries = default_http_retries
+http_backoff = 1.0
+http_connections = default_http_connections
+http_bandwidth = 0
+http_slots = threading.BoundedSemaphore(http_connections)
+http_pool = {}
+http_pool_lock = threading.Lock()
+http_throttle = {'next': 0.0}
+http_throttle_lock = threading.Lock()
+
+# Downloaded packages and release histories are kept in a cache, which is
+# shared by all Drupal installations on the machine. Set cache_dir to None to
+# disable it. In offline mode everything is taken from the cache.
+default_cache_dir = os.path.join(os.path.expanduser('~'), '.cache', 'drupal-updater')
+default_cache_size = 1024 # megabytes
+default_cache_max_age = 90 # days
+cache_dir = default_cache_dir
+cache_size = default_cache_size
+cache_max_age = default_cache_max_age
+offline = False
+
+# Diffs are constructed in-process, or with an external diff when diff_backend
+# is 'external'
+diff_backends = ['internal', 'external']
+diff_backend = 'internal'
+
+# Cached release histories younger than this number of seconds are used
+# without asking drupal.org whether they changed
+default_release_history_ttl = 0
+release_history_ttl = default_release_history_ttl
+
+# Files that are never part of a package, as gitignore style patterns, see
+# IgnoreMatcher. The patterns of a Drupal installation are read from
+# ignore_filename in its root, or from ignore_file when it is set. Without such
+# a file the default project patterns are used, which fit Voiture projects: the
+# void install profile, .htaccess and the ALLCAPS text files in the root are
+# removed or changed in those projects.
+default_ignore_patterns = ['.svn', '.git']
+default_project_ignore_patterns = ['/profiles/void', '/.htaccess', '/[A-Z]*.txt']
+ignore_filename = '.drupal-updater-ignore'
+ignore_file = None
+
+# Measurements of the run, see stage() and count(). None when nothing is
+# measured.
+instrumentation = None
+instrumentation_lock = threading.Lock()
+instrumentation_local = threading.local()
+
+# Directory with the releases that are shared by the Drupal installations of a
+# batch, see get_shared_release(). None when not running a batch.
+shared_release_dir = None
+shared_releases = {}
+shared_releases_lock = threading.Lock()
+
+# Build the new tree of a package next to the live one and swap it in with
+# renames, see swap_package()
+staged = False
+
+# Directories in which contrib packages are searched, relative to the Drupal
+# root, and the names of directories that are never searched
+discovery_paths = ['sites/*/modules', 'profiles/*/modules']
+default_discovery_prune = ['.svn', '.git', '.hg', '.bzr', 'CVS', 'node_modules']
+discovery_prune = default_discovery_prune
 
 ## Some regular expressions to be able to recognize projects correctly
 package_re = re.compile('^project = "(\w+)"$')
@@ -57,131 +118,637 @@ version_re = re.compile('^version = "([^"]+)"$')
 core_re = re.compile('^core = "?(\d+\.x)"?$')
 version_dev_re = re.compile('.*(dev|HEAD).*')
 version_split_re = re.compile('^(\d+\.x-)?(\d+)\..*$')
+patch_file_re = re.compile(r"^patching file (?:'(.*)'|(.*))$")
+patch_exists_re = re.compile(r"^The next patch would create the file (?:'(.*)'|(.*)),$")
+patch_failed_re = re.compile(r'^Hunk #\d+ FAILED')
+patch_fuzz_re = re.compile(r'^Hunk #\d+ succeeded at \d+ with fuzz')
+content_range_re = re.compile('^bytes (\d+)-\d+/(\d+)$')
 info_re = re.compile(r"\w+\.info")
 release_type_key = "Release type"
 required_release_types = ["Security update"]
 
-## Check if an info file is from a package. If so, return the package dict
+## Check if an info file is from a package. If so, return the package dict. The
+## file is read in a single pass.
 def get_package(info_file):
     pkg = {}
     with open(info_file) as f:
-        for line in f.readlines():
+        for line in f:
             m = package_re.match(line)
             if m:
                 pkg['name'] = m.group(1)
-        if not pkg.has_key('name'):
-            return False
-
-        f.seek(0)
-        for line in f.readlines():
+                continue
             m = version_re.match(line)
             if m:
                 pkg['version'] = m.group(1)
                 if version_dev_re.match(pkg['version']):
                     return False
-        if not pkg.has_key('version'):
-            return False
-
-        f.seek(0)
-        for line in f.readlines():
+                continue
             m = core_re.match(line)
             if m:
                 pkg['core'] = m.group(1)
-        if not pkg.has_key('core'):
-            return False
 
-        return pkg
+    if not pkg.has_key('name') or not pkg.has_key('version') or not pkg.has_key('core'):
+        return False
+    return pkg
 
-    return False
+## Same as get_package(), but remember the result in index, keyed by the path,
+## modification time and size of the info file, so unchanged files are not read
+## again.
+def get_indexed_package(info_file, index):
+    try:
+        st = os.stat(info_file)
+    except OSError:
+        return False
 
-## Fetch Drupal core package by looking at the system module
-system_pkg = get_package(os.path.join(os.getcwd(), 'modules/system/system.info'))
-if system_pkg:
-    system_pkg['location'] = os.getcwd()
-    packages.append(system_pkg)
+    entry = index.get(info_file)
+    if entry and entry[0] == st.st_mtime and entry[1] == st.st_size:
+        pkg = entry[2]
+    else:
+        pkg = get_package(info_file)
+        index[info_file] = [st.st_mtime, st.st_size, pkg]
+    if not pkg:
+        return False
+    # json gives unicode strings, but paths are constructed with these
+    return dict([ (str(key), value if isinstance(value, str) else value.encode('utf-8')) for key, value in pkg.items() ])
+
+## The index of parsed info files is kept in the cache directory
+def load_info_index():
+    if not cache_dir:
+        return {}
+    try:
+        with open(os.path.join(cache_dir, 'info-index.json')) as fp:
+            return dict([ (key.encode('utf-8'), entry) for key, entry in json.load(fp).items() ])
+    except (IOError, ValueError):
+        return {}
+
+def save_info_index(index):
+    if cache_dir:
+        write_file_atomic(os.path.join(cache_dir, 'info-index.json'), json.dumps(index))
+
+## List the names of the entries of a directory, with a flag telling if the
+## entry is a directory. Symlinks to directories are not followed, like
+## os.walk() does not follow them.
+if scandir:
+    def list_dir(path):
+        return [ (entry.name, entry.is_dir(follow_symlinks=False)) for entry in scandir(path) ]
 else:
-    print "Something went wrong. System not recognized as package?"
-    sys.exit()
+    def list_dir(path):
+        return [ (name, stat.S_ISDIR(os.lstat(os.path.join(path, name)).st_mode)) for name in os.listdir(path) ]
 
-## Walk over sites/all/modules
-for root, dirs, files in os.walk(os.path.join(os.getcwd(), 'sites/all/modules')):
+## Search a directory tree for contrib packages. The directory of a package is
+## not searched any further, because everything below it belongs to the package.
+def discover_packages(path, index, packages):
     try:
-        dirs.remove('.svn') # do not walk into .svn dirs
-    except ValueError:
-        pass
+        entries = sorted(list_dir(path))
+    except OSError:
+        return
 
-    for f in files:
-        if info_re.match(f):
-            contrib_pkg = get_package(os.path.join(root, f))
-            if contrib_pkg:
-                contrib_pkg['location'] = root
-                packages.append(contrib_pkg)
-                dirs[:] = []
-                break
+    for name, is_dir in entries:
+        if not is_dir and info_re.match(name):
+            pkg = get_indexed_package(os.path.join(path, name), index)
+            # core ships with modules in profiles that belong to core itself
+            if pkg and pkg['name'] != 'drupal':
+                pkg['location'] = path
+                packages.append(pkg)
+                return
 
-# Class to use a urllib2.urlopen in a with statement. Do not use directly, but
-# call the urlopen() method.
+    for name, is_dir in entries:
+        if is_dir and name not in discovery_prune:
+            discover_packages(os.path.join(path, name), index, packages)
+
+# Class to use a urllib2.urlopen in a with statement, for urls that are not
+# http(s), like file urls. Do not use directly, but call the urlopen() method.
 class FileURL:
-    def __init__(self, url):
+    def __init__(self, url, headers=None):
         self.url = url
+        self.headers = headers or {}
 
     def __enter__(self):
-        self.fp = urllib2.urlopen(self.url)
+        self.fp = urllib2.urlopen(urllib2.Request(self.url, headers=self.headers))
         return self.fp
 
     def __exit__(self, type, value, traceback):
         self.fp.close()
 
+# Error for HTTP responses that are not successful, like urllib2.HTTPError.
+# A 304 Not Modified response is an error as well.
+class HTTPError(IOError):
+    def __init__(self, url, code, reason, headers):
+        IOError.__init__(self, 'HTTP Error %d: %s (%s)' % (code, reason, url))
+        self.code = code
+        self.headers = headers
+
+    def info(self):
+        return self.headers
+
+# Class to read an http(s) url in a with statement. Connections are kept alive
+# and reused per host, see http_pool. Failed requests are retried with
+# exponential backoff, and a transfer that breaks off is resumed with a Range
+# request. At most http_connections transfers run at the same time, and
+# together they stay within http_bandwidth. Do not use directly, but call the
+# urlopen() method.
+class HTTPStream:
+    def __init__(self, url, headers=None):
+        self.url = url
+        self.headers = headers or {}
+        self.connection = None
+        self.response = None
+        self.reused = False
+        self.has_slot = False
+        self.attempt = 0
+        self.received = 0
+        self.resumed_at = 0
+        self.length = None
+        self.validator = None
+
+    def __enter__(self):
+        http_slots.acquire()
+        self.has_slot = True
+        try:
+            self.request(self.headers)
+        except:
+            self.close()
+            raise
+        self.length = self.get_length()
+        self.validator = self.response.getheader('ETag') or self.response.getheader('Last-Modified')
+        return self
+
+    def __exit__(self, type, value, traceback):
+        self.close()
+
+    def info(self):
+        return self.response.msg
+
+    # Send a GET request for the url, following redirects and retrying
+    # failures, until there is a successful response
+    def request(self, headers):
+        redirects = 0
+        while True:
+            try:
+                self.connect()
+                self.connection.request('GET', self.get_path(), headers=headers)
+                response = self.connection.getresponse()
+            except (socket.error, httplib.HTTPException) as e:
+                reused = self.reused
+                self.discard()
+                # the server may have closed a kept alive connection already
+                if not reused:
+                    self.retry(e)
+                continue
+
+            if response.status in (301, 302, 303, 307, 308) and redirects < 5:
+                response.read()
+                self.release(response)
+                self.url = urlparse.urljoin(self.url, response.getheader('Location'))
+                redirects += 1
+                continue
+            if response.status >= 500 or response.status in (408, 429):
+                response.read()
+                self.release(response)
+                self.retry(HTTPError(self.url, response.status, response.reason, response.msg))
+                continue
+            if response.status not in (200, 206):
+                response.read()
+                self.release(response)
+                raise HTTPError(self.url, response.status, response.reason, response.msg)
+            self.response = response
+            return
+
+    def get_path(self):
+        parts = urlparse.urlsplit(self.url)
+        return (parts.path or '/') + ('?' + parts.query if parts.query else '')
+
+    # Get the total length of the body from the response, if it is known
+    def get_length(self):
+        if self.response.status == 206:
+            match = content_range_re.match(self.response.getheader('Content-Range') or '')
+            return int(match.group(2)) if match else None
+        length = self.response.getheader('Content-Length')
+        return int(length) if length and length.isdigit() else None
+
+    # Take a connection to the host of the url from the pool, or open one
+    def connect(self):
+        parts = urlparse.urlsplit(self.url)
+        key = (parts.scheme, parts.netloc)
+        with http_pool_lock:
+            idle = http_pool.get(key)
+            self.connection = idle.pop() if idle else None
+        self.reused = self.connection is not None
+        if not self.connection:
+            connection_class = httplib.HTTPSConnection if parts.scheme == 'https' else httplib.HTTPConnection
+            self.connection = connection_class(parts.netloc, timeout=http_timeout)
+        self.key = key
+
+    # Put the connection back into the pool when the response was read
+    # completely, and close it otherwise
+    def release(self, response):
+        if not self.connection:
+            return
+        if response.isclosed() and not response.will_close:
+            with http_pool_lock:
+                idle = http_pool.setdefault(self.key, [])
+                if len(idle) < http_connections:
+                    idle.append(self.connection)
+                    self.connection = None
+                    return
+        self.discard()
+
+    def discard(self):
+        if self.connection:
+            self.connection.close()
+            self.connection = None
+
+    # Wait before the next attempt, or give up when there are no retries left
+    def retry(self, error):
+        if self.attempt >= http_retries:
+            raise IOError('Reading %s failed: %s' % (self.url, error))
+        count('http_retries')
+        time.sleep(http_backoff * 2 ** self.attempt)
+        self.attempt += 1
+
+    # Continue a transfer that broke off with a Range request. If the server
+    # sends anything but the rest of the same body, because it ignores the
+    # range or the body changed, the transfer fails: the part that was received
+    # is read already, and can not be combined with another body.
+    def resume(self, error):
+        self.discard()
+        # retries count the failures in a row, a transfer that keeps making
+        # progress is not given up on
+        if self.received > self.resumed_at:
+            self.attempt = 0
+        self.resumed_at = self.received
+        self.retry(error)
+        headers = dict(self.headers)
+        if self.received:
+            headers['Range'] = 'bytes=%d-' % self.received
+            if self.validator:
+                headers['If-Range'] = self.validator
+        self.request(headers)
+        if not self.received:
+            return
+        match = content_range_re.match(self.response.getheader('Content-Range') or '')
+        if self.response.status != 206 or not match or int(match.group(1)) != self.received:
+            raise IOError('Reading %s failed: %s, and the server did not resume the transfer' % (self.url, error))
+
+    def read(self, size=-1):
+        if size < 0:
+            chunks = []
+            while True:
+                data = self.read(2**16)
+                if not data:
+                    return ''.join(chunks)
+                chunks.append(data)
+
+        while True:
+            try:
+                data = self.response.read(size)
+                if not data and self.length is not None and self.received < self.length:
+                    raise httplib.IncompleteRead('', self.length - self.received)
+                break
+            except (socket.error, httplib.HTTPException) as e:
+                self.resume(e)
+        self.received += len(data)
+        throttle(len(data))
+        return data
+
+    def close(self):
+        if self.response:
+            self.release(self.response)
+            self.response = None
+        self.discard()
+        if self.has_slot:
+            http_slots.release()
+            self.has_slot = False
+
+# Close the idle connections in http_pool
+def close_http_connections():
+    with http_pool_lock:
+        for idle in http_pool.values():
+            for connection in idle:
+                connection.close()
+        http_pool.clear()
+
+# Wait until reading size more bytes fits in the bandwidth budget that all
+# transfers share
+def throttle(size):
+    if not http_bandwidth:
+        return
+    with http_throttle_lock:
+        now = time.time()
+        http_throttle['next'] = max(now, http_throttle['next']) + float(size) / http_bandwidth
+        delay = http_throttle['next'] - now - float(size) / http_bandwidth
+    if delay > 0:
+        time.sleep(delay)
+
 # Class to use a temporary directory in a with statement. The directory will be
 # removed when exitting the with statement. Do not use directly, but call the
 # tempdir() method.
 class TempDir:
+    def __init__(self, dir=None):
+        self.dir = dir
+
     def __enter__(self):
-        self.tmpdir = tempfile.mkdtemp()
+        self.tmpdir = tempfile.mkdtemp(dir=self.dir)
         return self.tmpdir
     def __exit__(self, type, value, traceback):
         shutil.rmtree(self.tmpdir)
 
-# Class to use a different working directory in a with statement. Do not use 
-# directly, but call the workingdir() method.
-class WorkingDirectory:
-    def __init__(self, wd):
-        self.wd = wd
+# Class to measure a stage of the run in a with statement. The stage is
+# recorded for package, or for the package of the stage it is nested in. Do
+# not use directly, but call the stage() method.
+class Stage:
+    def __init__(self, name, package=None):
+        self.name = name
+        self.package = package
+
     def __enter__(self):
-        self.old_wd = os.getcwd()
-        os.chdir(self.wd)
-        return self.wd
+        self.previous = getattr(instrumentation_local, 'package', None)
+        if self.package is not None:
+            instrumentation_local.package = self.package
+        self.start = time.time()
+
     def __exit__(self, type, value, traceback):
-        os.chdir(self.old_wd)
+        if instrumentation is not None:
+            record_stage(self.name, getattr(instrumentation_local, 'package', None), self.start, time.time() - self.start)
+        instrumentation_local.package = self.previous
+
+# Return a with statement compatible object that measures the wall time of a
+# stage of the run
+def stage(name, package=None):
+    return Stage(name, package)
+
+# Start measuring the stages of the run. With profile set, the main thread is
+# profiled with cProfile as well.
+def start_instrumentation(profile=False):
+    global instrumentation
+    instrumentation = {
+        'start': time.time(),
+        'stages': {},
+        'counters': {},
+        'packages': {},
+        'events': [],
+        'profiler': cProfile.Profile() if profile else None,
+    }
+    if instrumentation['profiler']:
+        instrumentation['profiler'].enable()
+
+# Get the measurements of a package, keyed by its location because batches can
+# have packages with the same name
+def get_instrumented_package(package):
+    key = package['location']
+    if not instrumentation['packages'].has_key(key):
+        instrumentation['packages'][key] = {
+            'name': package['name'],
+            'location': package['location'],
+            'stages': {},
+            'counters': {},
+        }
+    return instrumentation['packages'][key]
+
+# Add the time of a stage to the totals of the run and of package. Stages that
+# happen many times, like reading from the network, pass event=False to keep
+# them out of the trace.
+def record_stage(name, package, start, duration, event=True):
+    with instrumentation_lock:
+        stages = [ instrumentation['stages'] ]
+        if package is not None:
+            stages.append(get_instrumented_package(package)['stages'])
+        for s in stages:
+            if not s.has_key(name):
+                s[name] = {'time': 0.0, 'count': 0}
+            s[name]['time'] += duration
+            s[name]['count'] += 1
+        if event:
+            instrumentation['events'].append((name, package['name'] if package else None, start, duration, threading.current_thread().ident))
+
+# Add amount to a counter, like 'bytes_downloaded', 'bytes_read',
+# 'subprocesses' or 'files_touched', of the run and of the current package
+def count(key, amount=1):
+    if instrumentation is None:
+        return
+    package = getattr(instrumentation_local, 'package', None)
+    with instrumentation_lock:
+        counters = [ instrumentation['counters'] ]
+        if package is not None:
+            counters.append(get_instrumented_package(package)['counters'])
+        for c in counters:
+            c[key] = c.get(key, 0) + amount
+
+# Stop measuring, and write the JSON report, the trace in the trace event format
+# of chrome://tracing and the cProfile statistics to the files that are given.
+# Returns the measurements.
+def stop_instrumentation(report=None, trace=None, profile=None):
+    global instrumentation
+    measured = instrumentation
+    instrumentation = None
+    if measured['profiler']:
+        measured['profiler'].disable()
+        measured['profiler'].dump_stats(profile)
 
-# Return urllib2.urlopen() file handle wrapped in with statement compatible 
-# object
-def urlopen(url):
-    return FileURL(url)
+    if report:
+        with open(report, 'w') as fp:
+            json.dump({
+                'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime(measured['start'])),
+                'total_time': time.time() - measured['start'],
+                'stages': measured['stages'],
+                'counters': measured['counters'],
+                'packages': sorted(measured['packages'].values(), key=lambda package: package['location']),
+            }, fp, indent=2, sort_keys=True, separators=(',', ': '))
+
+    if trace:
+        events = []
+        for name, package, start, duration, thread in measured['events']:
+            events.append({
+                'name': name,
+                'cat': 'updater',
+                'ph': 'X',
+                'ts': int((start - measured['start']) * 1000000),
+                'dur': int(duration * 1000000),
+                'pid': os.getpid(),
+                'tid': thread,
+                'args': {'package': package},
+            })
+        with open(trace, 'w') as fp:
+            json.dump({'traceEvents': events, 'displayTimeUnit': 'ms'}, fp)
+    return measured
+
+# Class that replaces sys.stdout, so the output of packages that are updated at
+# the same time is not interleaved. A thread that calls capture() writes to a
+# buffer, which is printed in one go when it calls release().
+class ThreadOutput:
+    def __init__(self, stream):
+        self.stream = stream
+        self.local = threading.local()
+        self.lock = threading.Lock()
+
+    def write(self, data):
+        if getattr(self.local, 'buffer', None) is not None:
+            self.local.buffer.append(data)
+        else:
+            with self.lock:
+                self.stream.write(data)
+
+    def flush(self):
+        if getattr(self.local, 'buffer', None) is None:
+            self.stream.flush()
+
+    def capture(self):
+        self.local.buffer = []
+
+    def release(self):
+        data = ''.join(self.local.buffer)
+        self.local.buffer = None
+        with self.lock:
+            self.stream.write(data)
+            self.stream.flush()
+
+# Return a with statement compatible object that gives a file handle to read
+# url, with the request headers that are given. Raises HTTPError for
+# unsuccessful responses.
+def urlopen(url, headers=None):
+    if url.startswith('http://') or url.startswith('https://'):
+        return HTTPStream(url, headers)
+    return FileURL(url, headers)
 
 # Return a with statement compatible object that gives a temporary directory 
-# name
-def tempdir():
-    return TempDir()
-
-# Return a with statement compatible object that temporarily changes the
-# working directory.
-def workingdir(wd):
-    return WorkingDirectory(wd)
-
-# Walk through the package and index the existing files and directory
-def construct_filelist(path, ignore_list):
-    result = []
-    for root, dirs, files in os.walk(path):
-        # add the files that do not match with the ignore_list, to the result
-        result.extend([ os.path.relpath(os.path.join(root, f), path) for f in files if not len([ True for i in ignore_list if i.match(os.path.relpath(os.path.join(root, f), path)) ]) ])
-        # reduce the list of dirs to the directories that do not match with the ignore_list
-        dirs[:] = [ d for d in dirs if not len([ True for i in ignore_list if i.match(os.path.relpath(os.path.join(root, d), path)) ])]
-        # add the directories that remained in dirs to the result
-        result.extend([ os.path.relpath(os.path.join(root, d), path) for d in dirs])
-
-    result.sort()
-    return result
+# name, in dir if it is given
+def tempdir(dir=None):
+    return TempDir(dir)
+
+# Information about a file or directory in a tree. kind is 'file' or
+# 'directory', size and mtime come from os.stat().
+FileEntry = collections.namedtuple('FileEntry', ['path', 'kind', 'size', 'mtime'])
+
+# Sort key that orders the paths of a tree the way it is walked: the contents of
+# a directory come directly after the directory itself
+def path_sort_key(path):
+    return path.split('/')
+
+# Construct the FileEntry of a file. Broken symlinks are treated as files.
+def stat_entry(filename, path):
+    try:
+        st = os.stat(filename)
+    except OSError:
+        st = os.lstat(filename)
+    kind = 'directory' if stat.S_ISDIR(st.st_mode) else 'file'
+    return FileEntry(path, kind, st.st_size, st.st_mtime)
+
+# Translate a gitignore style glob to a regular expression. * and ? do not
+# match a /, ** matches anything.
+def glob_to_regex(pattern):
+    regex = ''
+    i = 0
+    while i < len(pattern):
+        c = pattern[i]
+        if pattern.startswith('**/', i):
+            regex += '(?:.*/)?'
+            i += 3
+            continue
+        if pattern.startswith('**', i):
+            regex += '.*'
+            i += 2
+            continue
+        if c == '*':
+            regex += '[^/]*'
+        elif c == '?':
+            regex += '[^/]'
+        elif c == '[' and ']' in pattern[i + 1:]:
+            end = pattern.index(']', i + 1)
+            characters = pattern[i + 1:end]
+            if characters.startswith('!'):
+                characters = '^' + characters[1:]
+            regex += '[' + characters + ']'
+            i = end
+        else:
+            regex += re.escape(c)
+        i += 1
+    return regex
+
+# Class that decides which files of a package are ignored, based on gitignore
+# style patterns: a pattern without a slash matches a name anywhere in the tree,
+# a pattern with a slash is relative to the root, and a pattern that ends in a
+# slash only matches directories. Everything below a matching directory is
+# ignored as well. Negated patterns are not supported. All patterns are
+# compiled into a single regular expression. Paths are relative to the package,
+# prefix is the location of the package relative to the root of the patterns.
+class IgnoreMatcher:
+    def __init__(self, patterns, prefix=''):
+        any_regexes = []
+        directory_regexes = []
+        for pattern in patterns:
+            pattern = pattern.strip()
+            if not pattern or pattern.startswith('#'):
+                continue
+            directory_only = pattern.endswith('/')
+            pattern = pattern.rstrip('/')
+            anchored = '/' in pattern
+            regex = glob_to_regex(pattern.lstrip('/'))
+            if not anchored:
+                regex = '(?:.*/)?' + regex
+            if directory_only:
+                any_regexes.append(regex + '/.*')
+                directory_regexes.append(regex)
+            else:
+                any_regexes.append(regex + '(?:/.*)?')
+
+        self.any_re = re.compile('^(?:%s)$' % '|'.join(any_regexes)) if any_regexes else None
+        self.directory_re = re.compile('^(?:%s)$' % '|'.join(directory_regexes)) if directory_regexes else None
+        self.prefix = prefix + '/' if prefix else ''
+
+    def match(self, path, is_dir=False):
+        path = self.prefix + path
+        if self.any_re and self.any_re.match(path):
+            return True
+        return bool(is_dir and self.directory_re and self.directory_re.match(path))
+
+# Walk through the package and index the existing files and directory. Yields
+# FileEntry tuples while walking, ordered by path_sort_key(). Ignored
+# directories are not walked into, and neither are symlinks to directories.
+def construct_filelist(path, ignore, relpath=''):
+    directory = os.path.join(path, relpath) if relpath else path
+    for name in sorted(os.listdir(directory)):
+        f = relpath + '/' + name if relpath else name
+        entry = stat_entry(os.path.join(directory, name), f)
+        if ignore.match(f, entry.kind == 'directory'):
+            continue
+        yield entry
+        if entry.kind == 'directory' and not os.path.islink(os.path.join(directory, name)):
+            for child in construct_filelist(path, ignore, f):
+                yield child
+
+# Compare two sequences of FileEntry tuples that are ordered by path_sort_key(),
+# in a single pass over both. Returns the paths that are only in original (added
+# files), only in downloaded (removed files) and in both (matching files).
+def compare_trees(downloaded, original):
+    added_files = []
+    removed_files = []
+    matching_files = []
+
+    downloaded = iter(downloaded)
+    original = iter(original)
+    a = next(downloaded, None)
+    b = next(original, None)
+    while a is not None and b is not None:
+        a_key = path_sort_key(a.path)
+        b_key = path_sort_key(b.path)
+        if a_key == b_key:
+            matching_files.append(a.path)
+            a = next(downloaded, None)
+            b = next(original, None)
+        elif a_key < b_key:
+            removed_files.append(a.path)
+            a = next(downloaded, None)
+        else:
+            added_files.append(b.path)
+            b = next(original, None)
+    while a is not None:
+        removed_files.append(a.path)
+        a = next(downloaded, None)
+    while b is not None:
+        added_files.append(b.path)
+        b = next(original, None)
+
+    return added_files, removed_files, matching_files
 
 # Get the first subdirectory of a path. This is because the tar.gz files from
 # drupal.org are constructed to create a subdirectory, but for drupal itself the
@@ -201,28 +768,120 @@ def extract_major(version):
         return m.group(2)
     return False
 
-# Find the latest release with the same major version
+# Parse a release history document from a file object, yielding the releases
+# newest first as soon as they are read. Only the information the updater needs
+# is kept, and every release is dropped from the tree once it has been yielded,
+# so memory use does not grow with the size of the document.
+def iter_release_history(fp):
+    releases_element = None
+    for event, element in ElementTree.iterparse(fp, events=('start', 'end')):
+        if event == 'start':
+            if element.tag == 'releases':
+                releases_element = element
+            continue
+        if element.tag != 'release':
+            continue
+
+        yield {
+            'version': element.findtext('version', ''),
+            'version_major': element.findtext('version_major', ''),
+            'release_types': [ term.findtext('value', '') for term in element.findall('terms/term') if term.findtext('name') == release_type_key ],
+            'md5': element.findtext('mdhash', ''),
+            'filesize': element.findtext('filesize', ''),
+        }
+        if releases_element is not None:
+            releases_element.clear()
+
+# Stream the releases of a project straight from drupal.org. The connection is
+# closed as soon as the caller stops iterating.
+def stream_release_history(url):
+    with urlopen(url) as response:
+        for release in iter_release_history(response):
+            yield release
+
+# json gives unicode strings, but paths are constructed with what is read from
+# the cache, so turn them back into utf-8 encoded strings, like
+# get_indexed_package() does
+def encode_json(value):
+    if isinstance(value, unicode):
+        return value.encode('utf-8')
+    if isinstance(value, list):
+        return [ encode_json(item) for item in value ]
+    if isinstance(value, dict):
+        return dict([ (encode_json(key), encode_json(item)) for key, item in value.items() ])
+    return value
+
+# Get the releases of a project. The parsed release history is cached together
+# with the ETag and Last-Modified headers of the response, so later runs only
+# need a conditional request, or no request at all within release_history_ttl
+# seconds. Without a cache the releases are streamed, so the download stops as
+# soon as the caller has found what it needs.
+def get_release_history(package_name, core):
+    url = drupal_release_info_base + package_name + '/' + core
+    if not cache_dir:
+        return stream_release_history(url)
+
+    cached = None
+    cache_file = os.path.join(cache_dir, 'release-history', package_name + '-' + core + '.json')
+    try:
+        with open(cache_file) as fp:
+            cached = encode_json(json.load(fp))
+    except (IOError, ValueError):
+        pass
+
+    if cached and (offline or time.time() - cached['fetched'] < release_history_ttl):
+        return cached['releases']
+    if offline:
+        raise IOError("release history of %s is not in the cache" % package_name)
+
+    headers = {}
+    if cached and cached['etag']:
+        headers['If-None-Match'] = cached['etag']
+    if cached and cached['last_modified']:
+        headers['If-Modified-Since'] = cached['last_modified']
+
+    try:
+        with urlopen(url, headers) as response:
+            releases = list(iter_release_history(response))
+            etag = response.info().getheader('ETag')
+            last_modified = response.info().getheader('Last-Modified')
+    except (HTTPError, urllib2.HTTPError) as e:
+        if e.code != 304 or not cached:
+            raise
+        # not modified, so the cached releases are still valid
+        releases = cached['releases']
+        etag = e.info().getheader('ETag') or cached['etag']
+        last_modified = e.info().getheader('Last-Modified') or cached['last_modified']
+
+    write_file_atomic(cache_file, json.dumps({
+        'etag': etag,
+        'last_modified': last_modified,
+        'fetched': time.time(),
+        'releases': releases,
+    }))
+    return releases
+
+# Find the latest release with the same major version. The releases that are
+# seen are kept in package['releases'], so the downloads can be verified
+# against their published hash. Reading stops at the release that is in use,
+# because everything after it is older.
 def get_best_version(package):
     major_version = extract_major(package['version'])
+    package['releases'] = {}
+    best_version = False
 
-    url = drupal_release_info_base + package['name'] + '/' + package['core']
-    with urlopen(url) as response:
-        xml = response.read()
-
-        dom = minidom.parseString(xml)
-        for release in dom.getElementsByTagName('release'):
-            version = ''.join([ node.data for node in release.getElementsByTagName('version')[0].childNodes if node.nodeType == node.TEXT_NODE])
-            if version == package['version']:
-                return version
-            if ''.join([ node.data for node in release.getElementsByTagName('version_major')[0].childNodes if node.nodeType == node.TEXT_NODE]) != major_version:
-                continue
-            
-            for term in release.getElementsByTagName('term'):
-                if ''.join([ node.data for node in term.getElementsByTagName('name')[0].childNodes if node.nodeType == node.TEXT_NODE]) == release_type_key:
-                    release_type = (''.join([ node.data for node in term.getElementsByTagName('value')[0].childNodes if node.nodeType == node.TEXT_NODE]))
-                    if release_type in required_release_types:
-                        return version
-    return False
+    for release in get_release_history(package['name'], package['core']):
+        version = release['version']
+        package['releases'][version] = release
+        if version == package['version']:
+            return best_version or version
+        if best_version or release['version_major'] != major_version:
+            continue
+
+        for release_type in release['release_types']:
+            if release_type in required_release_types:
+                best_version = version
+    return best_version
 
 # Check if a file is binary. Bit of a trick, it scans the first Kb of the file
 # for NULL bytes. GNU Diff and Git diff both work this way, but it fails with
@@ -240,253 +899,1386 @@ def is_binary(filename):
 
 # Construct a md5 hash for a file, without loading the whole file in memory
 def md5_for_file(filename, block_size=2**20):
+    with open(filename, 'rb') as f:
+        return md5_for_fileobj(f, block_size)
+
+# Construct a md5 hash for everything that can be read from a file object
+def md5_for_fileobj(f, block_size=2**20):
     md5 = hashlib.md5()
+    while True:
+        data = f.read(block_size)
+        if not data:
+            break
+        md5.update(data)
+        count('bytes_read', len(data))
+    return md5.digest()
+
+# Check if two files have the same contents. The size is compared first, so
+# most different files are recognized without reading them.
+def files_identical(a, b):
+    if not os.path.isfile(a) or not os.path.isfile(b):
+        return False
+    if os.path.getsize(a) != os.path.getsize(b):
+        return False
+    return md5_for_file(a) == md5_for_file(b)
 
+# Read the lines of a file, keeping the line endings. Only newlines end a line,
+# like they do for diff and patch.
+def read_lines(filename):
+    if not os.path.isfile(filename):
+        return []
     with open(filename, 'rb') as f:
-        while True:
-            data = f.read(block_size)
-            if not data:
-                break
-            md5.update(data)
-    return md5.digest()
+        data = f.read()
+    count('bytes_read', len(data))
+    lines = data.split('\n')
+    last = lines.pop()
+    lines = [ line + '\n' for line in lines ]
+    if last:
+        lines.append(last)
+    return lines
+
+# Format the modification time of a file like diff does. A missing file gets
+# the epoch, which tells patch to create or remove the file.
+def diff_file_date(filename):
+    if not os.path.isfile(filename):
+        return '1970-01-01 00:00:00.000000000 +0000'
+    mtime = os.path.getmtime(filename)
+    return time.strftime('%Y-%m-%d %H:%M:%S', time.gmtime(mtime)) + '.%09d +0000' % ((mtime % 1) * 1e9)
+
+# Construct a unified diff between the version of a file in original_location
+# and the one in location, that can be applied with patch -p0 from within
+# location. A missing file is treated as an empty file. Returns False if the
+# files are the same.
+def diff_files(path, original_location, location):
+    a = os.path.join(original_location, path)
+    b = os.path.join(location, path)
+    if files_identical(a, b):
+        return False
+
+    if diff_backend == 'external':
+        count('subprocesses')
+        try:
+            subprocess.check_output(['diff', '-uN', a, b], stderr=subprocess.STDOUT)
+        except subprocess.CalledProcessError as e:
+            return e.output.replace(location + '/', '').replace(original_location + '/', '')
+        return False
+
+    output = []
+    for line in difflib.unified_diff(read_lines(a), read_lines(b), path, path, diff_file_date(a), diff_file_date(b)):
+        output.append(line)
+        if not line.endswith('\n'):
+            output.append('\n\\ No newline at end of file\n')
+    return ''.join(output) or False
 
 # Construct the url to download a certain version of a package from
 def get_download_url(package_name, version):
     return drupal_download_base + package_name + '-' + version + '.' + drupal_download_extension
 
-# loop over the found packages
-for package in packages:
-    print "\nStart analysing %s" % package['name']
-    package['best_version'] = get_best_version(package)
+# Create a directory if it does not exist yet. Other processes may be creating
+# the same directory at the same time.
+def ensure_dir(path):
+    if not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):
+                raise
 
-    if package['version'] == package['best_version']:
-        print "Does not need to be updated. Skip it"
-        continue
-
-    # download the package from the version that we use
-    url = get_download_url(package['name'], package['version'])
-    filename = package['name'] + '.' + drupal_download_extension
-    with tempdir() as download_dir:
-        with urlopen(url) as response:
-            with open(os.path.join(download_dir, filename),'wb') as output:
-                output.write(response.read())
-
-        # extract the package
-        with tempdir() as extract_dir:
-            output = subprocess.check_output(['tar','-x','-C',extract_dir,'-f',os.path.join(download_dir, filename)],stderr=subprocess.STDOUT)
-            if output:
-                print "Extracting package failed. Skipping"
-                continue
+# Write a file under a temporary name first, and move it into place when it is
+# complete. Other processes sharing the cache never see half written files.
+def write_file_atomic(path, data):
+    ensure_dir(os.path.dirname(path))
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), prefix='.tmp-')
+    with os.fdopen(fd, 'wb') as fp:
+        fp.write(data)
+    os.rename(tmp, path)
 
-            # construct a list of regular expressions to ignore some files
-            ignore_list = [
-                re.compile('^(.*/)?\.svn$'), # always ignore .svn
-                re.compile('^(.*/)?\.git$'), # always ignore .git
-            ]
-            if package['name'] == 'drupal':
-                ignore_list.extend([
-                    re.compile('^sites$'), # ignore sites directory
-                    re.compile('^profiles/void$'), # ignore voiture void install profile
-                    re.compile('^.htaccess$'), # ignore .htaccess, because it is removed for voiture projects
-                    re.compile('^[A-Z]+(\.\w+)+$') # ignore ALLCAPS files in root, because we usually remove them
-                ])
-
-            # construct list of all dirs and files of existing package
-            original_filelist = construct_filelist(package['location'], ignore_list)
-
-            # construct list of all dirs and files in downloaded package
-            download_location = find_download_location(extract_dir)
-            if not download_location:
-                print "Extracting package not found. Skipping"
-                continue
-            downloaded_filelist = construct_filelist(download_location, ignore_list)
-
-            # use difflib to construct lists of matching and not matching files
-            added_files = []
-            removed_files = []
-            matching_files = []
-            d = difflib.SequenceMatcher(None, downloaded_filelist, original_filelist)
-            for tag, i1, i2, j1, j2 in d.get_opcodes():
-                if tag == 'insert':
-                    added_files.extend(original_filelist[j1:j2])
-                elif tag == 'delete':
-                    removed_files.extend(downloaded_filelist[i1:i2])
-                elif tag == 'replace':
-                    added_files.extend(original_filelist[j1:j2])
-                    removed_files.extend(downloaded_filelist[i1:i2])
-                elif tag == 'equal':
-                    matching_files.extend(downloaded_filelist[i1:i2])
-
-            # loop over the files that we have in both tree
-            for f in matching_files:
-                # detect directories and weird stuff with directories
-                if os.path.isdir(os.path.join(download_location, f)) != os.path.isdir(os.path.join(package['location'], f)):
-                    print 'Problem with %s. Only one is a directory. Skipping' % f
+# The download cache is content addressed: tarballs are stored by their md5
+# hash in objects/, and keys/PACKAGE-VERSION contains the hash of the tarball
+# of that release. The modification time of an object is used to evict the
+# least recently used objects.
+def get_cache_key_path(package_name, version):
+    return os.path.join(cache_dir, 'tarballs', 'keys', package_name + '-' + version)
+
+def get_cache_object_path(md5):
+    return os.path.join(cache_dir, 'tarballs', 'objects', md5 + '.' + drupal_download_extension)
+
+# Find a tarball in the download cache. Returns False if it is not there, or
+# if it does not match the expected md5 hash.
+def cache_lookup(package_name, version, md5=None):
+    try:
+        with open(get_cache_key_path(package_name, version)) as fp:
+            cached_md5 = fp.read().strip()
+    except IOError:
+        return False
+    if md5 and md5 != cached_md5:
+        return False
+
+    path = get_cache_object_path(cached_md5)
+    try:
+        os.utime(path, None) # mark as recently used
+    except OSError:
+        return False
+    return path
+
+# Move a verified tarball, which must be on the same filesystem, into the
+# download cache
+def cache_store(package_name, version, filename, md5):
+    os.rename(filename, get_cache_object_path(md5))
+    write_file_atomic(get_cache_key_path(package_name, version), md5)
+    prune_cache()
+
+# Remove objects from the download cache that have not been used for
+# cache_max_age days, and then the least recently used objects until the
+# cache is no larger than cache_size megabytes.
+def prune_cache():
+    objects_dir = os.path.join(cache_dir, 'tarballs', 'objects')
+    objects = []
+    for f in os.listdir(objects_dir):
+        try:
+            st = os.stat(os.path.join(objects_dir, f))
+        except OSError:
+            continue # removed by someone else
+        objects.append((st.st_mtime, st.st_size, os.path.join(objects_dir, f)))
+    objects.sort()
+
+    total = sum([ size for mtime, size, path in objects ])
+    oldest = time.time() - cache_max_age * 24 * 60 * 60
+    for mtime, size, path in objects:
+        if mtime >= oldest and total <= cache_size * 1024 * 1024:
+            break
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+        total -= size
+
+# Class that wraps a file object to compute the md5 hash of everything that is
+# read through it, and optionally write a copy of it to another file.
+class HashingReader:
+    def __init__(self, fp, copy=None):
+        self.fp = fp
+        self.copy = copy
+        self.md5 = hashlib.md5()
+
+    def read(self, size=-1):
+        return self.consume(self.fp.read(size))
+
+    def consume(self, data):
+        self.md5.update(data)
+        if self.copy:
+            self.copy.write(data)
+        return data
+
+    # read the rest of the file, so the hash covers everything
+    def drain(self, block_size=2**16):
+        while self.read(block_size):
+            pass
+
+    def hexdigest(self):
+        return self.md5.hexdigest()
+
+# HashingReader for a download, which adds the time spent reading from the
+# network and the bytes read to the download stage of the instrumentation
+class DownloadReader(HashingReader):
+    def read(self, size=-1):
+        start = time.time()
+        data = self.fp.read(size)
+        if instrumentation is not None:
+            record_stage('download', getattr(instrumentation_local, 'package', None), start, time.time() - start, False)
+            count('bytes_downloaded', len(data))
+        return self.consume(data)
+
+# Check that a tar member can not put anything outside of destination, through
+# its name, the target of a link, or a link that is already in destination.
+# Returns False if the member has to be refused.
+def safe_tar_member(member, destination):
+    parts = member.name.rstrip('/').split('/')
+    if os.path.isabs(member.name) or '..' in parts:
+        return False
+    if member.issym() or member.islnk():
+        if member.issym():
+            target = os.path.join(os.path.dirname(member.name), member.linkname)
+        else:
+            target = member.linkname
+        if os.path.isabs(member.linkname) or os.path.normpath(target).split('/')[0] == '..':
+            return False
+    for i in range(1, len(parts) + 1):
+        if os.path.islink(os.path.join(destination, *parts[:i])):
+            return False
+    return True
+
+# Extract a tar.gz file while it is being read, without a temporary copy of it.
+# Members that are ignored, relative to the directory the tarball creates, are
+# skipped. Returns False if the tarball is broken or tries to put
+# files outside of the destination.
+def extract_tarball(fp, destination, ignore):
+    try:
+        with tarfile.open(fileobj=fp, mode='r|gz') as tar:
+            for member in tar:
+                if not safe_tar_member(member, destination):
+                    print "Refusing to extract %s" % member.name
+                    return False
+                parts = member.name.split('/', 1)
+                if len(parts) == 2 and ignore.match(parts[1], member.isdir()):
                     continue
-                elif os.path.isdir(os.path.join(download_location, f)):
+                tar.extract(member, destination)
+    except (tarfile.TarError, IOError, EOFError, zlib.error) as e:
+        print "Reading tarball failed: %s" % e
+        return False
+    return True
+
+# Compare a tar.gz file with the installed files of a package while it is being
+# read, instead of extracting it. Files are compared by size first and by md5
+# hash second. Only the members that differ from the installed files, and
+# directories, are written to destination. Returns a dict that maps the paths
+# in the tarball, relative to the directory it creates, to 'directory',
+# 'identical' or 'different', or False if the tarball is broken.
+def verify_tarball(fp, location, destination, ignore):
+    members = {}
+    try:
+        with tarfile.open(fileobj=fp, mode='r|gz') as tar:
+            for member in tar:
+                if not safe_tar_member(member, destination):
+                    print "Refusing to extract %s" % member.name
+                    return False
+                parts = member.name.split('/', 1)
+                ensure_dir(os.path.join(destination, parts[0]))
+                if len(parts) != 2 or not parts[1] or ignore.match(parts[1], member.isdir()):
                     continue
+                path = parts[1]
 
-                if is_binary(os.path.join(package['location'], f)):
-                    # handle binary files
-                    if md5_for_file(os.path.join(download_location, f)) != md5_for_file(os.path.join(package['location'], f)):
-                        if not os.path.isdir(os.path.dirname(os.path.join(patches_path, package['name'], f))):
-                            os.makedirs(os.path.dirname(os.path.join(patches_path, package['name'], f)))
-                        shutil.copyfile(os.path.join(package['location'], f), os.path.join(patches_path, package['name'], f))
-                        print 'Diff in binary file %s. Copied to patches directory.' % f
-                else:
-                    # handle text files
-                    output = False
-
-                    # get diff and write to patch file if files are different
-                    try:
-                        subprocess.check_output([
-                            'diff','-u', 
-                            os.path.join(download_location, f), 
-                            os.path.join(package['location'], f)
-                        ],stderr=subprocess.STDOUT)
-                    except subprocess.CalledProcessError as e:
-                        output = e.output
-                        if not os.path.isdir(os.path.dirname(os.path.join(patches_path, package['name'], f))):
-                            os.makedirs(os.path.dirname(os.path.join(patches_path, package['name'], f)))
-                        with open(os.path.join(patches_path, package['name'], f + '.patch'), 'w') as fp:
-                            fp.write(output.replace(package['location'] + '/', '').replace(download_location + '/', ''))
-                        print 'Diff in text file %s. Created patch file in patches directory.' % f
-
-            # loop over the files that are in our tree, but not in the downloaded tree
-            for f in added_files:
-                if os.path.isdir(os.path.join(package['location'], f)):
-                    if not os.path.isdir(os.path.join(patches_path, package['name'], f)):
-                        os.makedirs(os.path.join(patches_path, package['name'], f))
-                    print "Directory %s added. Created directory in patches directory." % f
+                # make sure the parent directories are known, even if the
+                # tarball does not contain them
+                parent = os.path.dirname(path)
+                while parent and not members.has_key(parent):
+                    members[parent] = 'directory'
+                    ensure_dir(os.path.join(destination, parts[0], parent))
+                    parent = os.path.dirname(parent)
+
+                if member.isdir():
+                    members[path] = 'directory'
+                    ensure_dir(os.path.join(destination, member.name))
                     continue
 
-                if is_binary(os.path.join(package['location'], f)):
-                    # handle binary files
-                    if not os.path.isdir(os.path.dirname(os.path.join(patches_path, package['name'], f))):
-                        os.makedirs(os.path.dirname(os.path.join(patches_path, package['name'], f)))
-                    shutil.copyfile(os.path.join(package['location'], f), os.path.join(patches_path, package['name'], f))
-                    print 'Added binary file %s. Copied to patches directory.' % f
-                else:
-                    # handle text files
-                    output = False
-
-                    # get diff and write to patch file if files are different
-                    try:
-                        subprocess.check_output([
-                            'diff','-uN', 
-                            os.path.join(download_location, f), # we need a location that we kwow is non-existant
-                            os.path.join(package['location'], f)
-                        ],stderr=subprocess.STDOUT)
-                    except subprocess.CalledProcessError as e:
-                        output = e.output
-                        if not os.path.isdir(os.path.dirname(os.path.join(patches_path, package['name'], f))):
-                            os.makedirs(os.path.dirname(os.path.join(patches_path, package['name'], f)))
-                        with open(os.path.join(patches_path, package['name'], f + '.patch'), 'w') as fp:
-                            fp.write(output.replace(package['location'] + '/', '').replace(download_location + '/', ''))
-                        print 'Added text file %s. Created patch file in patches directory.' % f
-
-            # loop over the files that are in the downloaded tree, but not in our tree
-            for f in removed_files:
-                if os.path.isdir(os.path.join(download_location, f)):
-                    print "Directory %s is removed. Ignoring" % f
+                members[path] = 'different'
+                installed = os.path.join(location, path)
+                if not member.isfile() or not os.path.isfile(installed) or os.path.islink(installed) or os.path.getsize(installed) != member.size:
+                    tar.extract(member, destination)
                     continue
 
-                if is_binary(os.path.join(download_location, f)):
-                    # handle binary files
-                    if not os.path.isdir(os.path.dirname(os.path.join(patches_path, package['name'], f))):
-                        os.makedirs(os.path.dirname(os.path.join(patches_path, package['name'], f)))
-                    shutil.copyfile(os.path.join(download_location, f), os.path.join(patches_path, package['name'], f + '.remove'))
-                    print 'Removed binary file %s. Copied to patches directory with a .remove suffix.' % f
-                else:
-                    # handle text files
-                    output = False
-
-                    # get diff and write to patch file if files are different
-                    try:
-                        subprocess.check_output([
-                            'diff','-uN', 
-                            os.path.join(download_location, f),
-                            os.path.join(package['location'], f) # we need a location that we kwow is non-existant
-                        ],stderr=subprocess.STDOUT)
-                    except subprocess.CalledProcessError as e:
-                        output = e.output
-                        if not os.path.isdir(os.path.dirname(os.path.join(patches_path, package['name'], f))):
-                            os.makedirs(os.path.dirname(os.path.join(patches_path, package['name'], f)))
-                        with open(os.path.join(patches_path, package['name'], f + '.patch'), 'w') as fp:
-                            fp.write(output.replace(package['location'] + '/', '').replace(download_location + '/', ''))
-                        print 'Removed text file %s. Created patch file in patches directory.' % f
-
-            print "Updating package"
-
-            # download the package from the best version
-            best_url = get_download_url(package['name'], package['best_version'])
-            with tempdir() as best_download_dir:
-                with urlopen(best_url) as response:
-                    with open(os.path.join(best_download_dir, filename),'wb') as output:
-                        output.write(response.read())
-
-                # extract the package
-                with tempdir() as best_extract_dir:
-                    output = subprocess.check_output(['tar','-x','-C',best_extract_dir,'-f',os.path.join(best_download_dir, filename)],stderr=subprocess.STDOUT)
-                    if output:
-                        print "Extracting package failed. Skipping"
+                # the stream can not be read twice, so keep a copy of the member
+                # while hashing it in case it turns out to be different
+                with tempfile.SpooledTemporaryFile(max_size=2**20) as spool:
+                    if md5_for_fileobj(HashingReader(tar.extractfile(member), spool)) == md5_for_file(installed):
+                        members[path] = 'identical'
                         continue
+                    spool.seek(0)
+                    target = os.path.join(destination, member.name)
+                    with open(target, 'wb') as output:
+                        shutil.copyfileobj(spool, output)
+                    os.chmod(target, member.mode)
+                    os.utime(target, (member.mtime, member.mtime))
+    except (tarfile.TarError, IOError, EOFError, zlib.error) as e:
+        print "Reading tarball failed: %s" % e
+        return False
+    return members
+
+# Read the tarball of a version of a package and pass it to handler. The
+# tarball is taken from the download cache, or streamed from drupal.org straight
+# into the handler while it is copied to the cache. Downloads are verified
+# against the md5 hash that is published in the release history. Returns the
+# result of the handler, or False if the package could not be read.
+def read_package(package, version, handler):
+    md5 = package.get('releases', {}).get(version, {}).get('md5')
+
+    if cache_dir:
+        cached = cache_lookup(package['name'], version, md5)
+        if cached:
+            count('bytes_read', os.path.getsize(cached))
+            with open(cached, 'rb') as fp:
+                return handler(fp)
+    if offline:
+        print "%s %s is not in the download cache" % (package['name'], version)
+        return False
+
+    copy = None
+    if cache_dir:
+        objects_dir = os.path.join(cache_dir, 'tarballs', 'objects')
+        ensure_dir(objects_dir)
+        fd, copy_filename = tempfile.mkstemp(dir=objects_dir, prefix='.tmp-')
+        copy = os.fdopen(fd, 'wb')
+
+    try:
+        with urlopen(get_download_url(package['name'], version)) as response:
+            reader = DownloadReader(response, copy)
+            result = handler(reader)
+            reader.drain()
+    except IOError as e:
+        print "Downloading %s %s failed: %s" % (package['name'], version, e)
+        result = False
+    finally:
+        if copy:
+            copy.close()
+
+    if result is not False and md5 and md5 != reader.hexdigest():
+        print "Downloaded %s %s does not match the published md5 hash" % (package['name'], version)
+        result = False
+    if copy:
+        if result is not False:
+            cache_store(package['name'], version, copy_filename, reader.hexdigest())
+        else:
+            os.remove(copy_filename)
+    return result
+
+# Extract a version of a package into destination. Returns False if the package
+# could not be extracted.
+def extract_package(package, version, destination, ignore):
+    with stage('extract', package):
+        return read_package(package, version, lambda fp: extract_tarball(fp, destination, ignore))
+
+# Compare a version of a package with the installed package, see
+# verify_tarball(). Returns False if the package could not be read.
+def verify_package(package, version, destination, ignore):
+    with stage('extract', package):
+        return read_package(package, version, lambda fp: verify_tarball(fp, package['location'], destination, ignore))
+
+# Get the extracted release of a package that is shared by the Drupal
+# installations of a batch. Every release is extracted once, in
+# shared_release_dir. Returns the directory the tarball created, or False.
+def get_shared_release(package, version):
+    key = (package['name'], version)
+    with shared_releases_lock:
+        if not shared_releases.has_key(key):
+            shared_releases[key] = {'lock': threading.Lock(), 'location': None}
+        release = shared_releases[key]
+
+    with release['lock']:
+        if release['location'] is None:
+            destination = os.path.join(shared_release_dir, '%s-%s' % key)
+            ensure_dir(destination)
+            if extract_package(package, version, destination, IgnoreMatcher([])):
+                release['location'] = find_download_location(destination)
+            else:
+                release['location'] = False
+    return release['location']
+
+# Compare the extracted release at release_location with the installed files
+# at location. Returns a dict like verify_tarball() does.
+def verify_tree(release_location, location, ignore):
+    members = {}
+    for entry in construct_filelist(release_location, ignore):
+        if entry.kind == 'directory':
+            members[entry.path] = 'directory'
+        elif files_identical(os.path.join(release_location, entry.path), os.path.join(location, entry.path)):
+            members[entry.path] = 'identical'
+        else:
+            members[entry.path] = 'different'
+    return members
+
+# Copy the files of an extracted release to destination
+def copy_tree(source, destination, ignore):
+    ensure_dir(destination)
+    for entry in construct_filelist(source, ignore):
+        if entry.kind == 'directory':
+            os.mkdir(os.path.join(destination, entry.path))
+        else:
+            shutil.copy2(os.path.join(source, entry.path), os.path.join(destination, entry.path))
+            count('files_touched')
+
+# Find the packages in a Drupal installation. Returns False if Drupal core
+# itself could not be recognized.
+def find_packages(drupal_root):
+    packages = []
+    index = load_info_index()
+
+    ## Fetch Drupal core package by looking at the system module
+    system_pkg = get_indexed_package(os.path.join(drupal_root, 'modules/system/system.info'), index)
+    if not system_pkg:
+        return False
+    system_pkg['location'] = drupal_root
+    packages.append(system_pkg)
+
+    ## Walk over the module directories of all sites and profiles
+    for pattern in discovery_paths:
+        for path in sorted(glob.glob(os.path.join(drupal_root, pattern))):
+            discover_packages(path, index, packages)
+
+    save_info_index(index)
+    for pkg in packages:
+        pkg['drupal_root'] = drupal_root
+    # contrib packages in profiles are inside the tree of core
+    system_pkg['contrib_locations'] = [ os.path.relpath(pkg['location'], drupal_root) for pkg in packages[1:] ]
+    return packages
+
+# Call function for every item, using at most `count` threads at the same time.
+# Returns when all items are done.
+def run_in_threads(function, items, count):
+    queue = Queue.Queue()
+    for item in items:
+        queue.put(item)
+
+    def worker():
+        while True:
+            try:
+                item = queue.get_nowait()
+            except Queue.Empty:
+                return
+            function(item)
+
+    threads = [ threading.Thread(target=worker) for i in range(max(1, min(count, len(items)))) ]
+    for t in threads:
+        t.daemon = True
+        t.start()
+    for t in threads:
+        # join with a timeout, so a KeyboardInterrupt still gets through
+        while t.is_alive():
+            t.join(0.1)
+
+# Look up the best version of all packages, with at most `concurrency` release
+# history requests running at the same time. The result is stored in
+# package['best_version'], or package['error'] when the lookup failed. Returns
+# the packages that need to be updated, in the order they were given.
+def prefetch_best_versions(packages, concurrency=default_concurrency):
+    lookup_best_versions(packages, concurrency)
+    return report_best_versions(packages)
+
+# Look up the best versions of packages in `concurrency` threads. Packages with
+# the same name, core and version, for example in different sites, are looked
+# up once.
+def lookup_best_versions(packages, concurrency=default_concurrency):
+    groups = {}
+    for package in packages:
+        groups.setdefault((package['name'], package['core'], package['version']), []).append(package)
+
+    def lookup(group):
+        package = group[0]
+        try:
+            with stage('release-history', package):
+                package['best_version'] = get_best_version(package)
+        except Exception as e:
+            # exceptions do not leave the thread, so keep it with the package
+            package['best_version'] = False
+            package['error'] = str(e)
+        for other in group[1:]:
+            for key in ['best_version', 'releases', 'error']:
+                if package.has_key(key):
+                    other[key] = package[key]
+
+    run_in_threads(lookup, groups.values(), concurrency)
+
+# Print the outcome of lookup_best_versions(). Returns the packages that need
+# to be updated.
+def report_best_versions(packages):
+    outdated = []
+    for package in packages:
+        if package.has_key('error'):
+            print "Looking up %s failed (%s). Skip it" % (package['name'], package['error'])
+        elif not package['best_version']:
+            print "No suitable release of %s found. Skip it" % package['name']
+        elif package['version'] == package['best_version']:
+            print "%s %s does not need to be updated" % (package['name'], package['version'])
+        else:
+            print "%s %s will be updated to %s" % (package['name'], package['version'], package['best_version'])
+            outdated.append(package)
+    return outdated
+
+# Ask for the directory to put the patches in, and create it if needed
+def ask_patches_path(drupal_root):
+    print "Enter the path to place patch files is. Relative to working dir."
+    patches_path = False
+    while not patches_path:
+        patches_path = raw_input("Enter: ")
+    return ensure_patches_path(os.path.join(drupal_root, patches_path))
+
+# Create the directory to put the patches in if needed
+def ensure_patches_path(patches_path):
+    if not os.path.isdir(patches_path):
+        try:
+            os.makedirs(patches_path)
+            print "Directory created"
+        except:
+            print "Creating dir failed"
+            sys.exit()
+    else:
+        print "Directory already exists. Using it."
+    return patches_path
+
+# Read the ignore patterns of a Drupal installation from ignore_file, or from
+# ignore_filename in its root. Without such a file,
+# default_project_ignore_patterns are used.
+def get_project_ignore_patterns(drupal_root):
+    filename = ignore_file or os.path.join(drupal_root, ignore_filename)
+    if not os.path.isfile(filename):
+        return default_project_ignore_patterns
+    with open(filename) as fp:
+        return fp.read().splitlines()
+
+# Construct the matcher for the files of a package that are ignored. Drupal core
+# always ignores the sites directory, which holds the contrib packages and the
+# files of the sites, and the contrib packages that were found in profiles.
+def get_ignore_matcher(package):
+    patterns = list(default_ignore_patterns)
+    if package['name'] == 'drupal':
+        patterns.append('/sites')
+        patterns.extend([ '/' + location for location in package.get('contrib_locations', []) ])
+    patterns.extend(get_project_ignore_patterns(package['drupal_root']))
+
+    prefix = os.path.relpath(package['location'], package['drupal_root'])
+    return IgnoreMatcher(patterns, '' if prefix == '.' else prefix)
+
+# Compare the installed package with the version it claims to be. The files of
+# that version that differ from the installed files are extracted in
+# extract_dir. Returns a dict with the lists of added, removed and matching
+# files, or False if the package could not be compared.
+def compare_package(package, extract_dir, ignore):
+    if shared_release_dir:
+        # a batch compares with the shared release, extract_dir stays empty
+        download_location = get_shared_release(package, package['version'])
+        if not download_location:
+            print "Extracting package failed. Skipping"
+            return False
+        downloaded_members = verify_tree(download_location, package['location'], ignore)
+    else:
+        downloaded_members = verify_package(package, package['version'], extract_dir, ignore)
+        if downloaded_members is False:
+            print "Extracting package failed. Skipping"
+            return False
+        download_location = find_download_location(extract_dir)
+        if not download_location:
+            print "Extracting package not found. Skipping"
+            return False
+
+    # construct list of all dirs and files of existing package
+    with stage('filelist'):
+        original_filelist = list(construct_filelist(package['location'], ignore))
+
+    # construct list of all dirs and files in downloaded package
+    downloaded_filelist = [ FileEntry(f, 'directory' if downloaded_members[f] == 'directory' else 'file', None, None) for f in downloaded_members ]
+    downloaded_filelist.sort(key=lambda entry: path_sort_key(entry.path))
+
+    # construct lists of matching and not matching files
+    with stage('classify'):
+        added_files, removed_files, matching_files = compare_trees(downloaded_filelist, original_filelist)
+
+    return {
+        'download_location': download_location,
+        'downloaded_members': downloaded_members,
+        'downloaded_entries': dict([ (entry.path, entry) for entry in downloaded_filelist ]),
+        'original_filelist': original_filelist,
+        'original_entries': dict([ (entry.path, entry) for entry in original_filelist ]),
+        'added_files': added_files,
+        'removed_files': removed_files,
+        'matching_files': matching_files,
+    }
+
+# Directory next to the Drupal root in which staged updates build the new trees
+# of packages, and keep the previous ones. It is outside of the Drupal root, so
+# Drupal does not find the modules in it, but normally on the same filesystem.
+def get_staging_root(drupal_root):
+    return os.path.join(os.path.dirname(drupal_root), '.drupal-updater-' + os.path.basename(drupal_root))
+
+# Location of the 'staging' (new) or 'old' (previous) tree of a package
+def get_staging_path(package, kind):
+    relpath = os.path.relpath(package['location'], package['drupal_root'])
+    key = 'core' if relpath == '.' else os.path.join('contrib', relpath)
+    return os.path.join(get_staging_root(package['drupal_root']), kind, key)
+
+# Remove the previous trees of the last staged update of a Drupal installation
+def clear_old_trees(drupal_root):
+    old = os.path.join(get_staging_root(drupal_root), 'old')
+    if os.path.isdir(old):
+        shutil.rmtree(old)
+
+# Make sure the staging tree of a package can be built. The tree must be on the
+# same filesystem as the package, so it can be renamed into place. A staging
+# tree that is left behind is removed, unless it holds ignored files: those
+# were moved out of the live tree by a swap that did not finish, and may be the
+# only copy. Returns the location of the staging tree, or False.
+def prepare_staging(package):
+    staging = get_staging_path(package, 'staging')
+    ensure_dir(os.path.dirname(staging))
+    if os.path.exists(staging):
+        if any(find_ignored(staging, get_ignore_matcher(package))):
+            print "Staging directory %s holds ignored files of the package, like uploaded files. Move them back into %s and remove the directory. Skipping" % (staging, package['location'])
+            return False
+        shutil.rmtree(staging)
+    if os.stat(os.path.dirname(staging)).st_dev != os.stat(package['location']).st_dev:
+        print "Staging directory %s is not on the filesystem of the package. Skipping" % staging
+        return False
+    return staging
+
+# Find the ignored files and directories of a tree. Ignored directories are not
+# walked into.
+def find_ignored(path, ignore, relpath=''):
+    directory = os.path.join(path, relpath) if relpath else path
+    for name in sorted(os.listdir(directory)):
+        f = relpath + '/' + name if relpath else name
+        filename = os.path.join(directory, name)
+        if ignore.match(f, os.path.isdir(filename)):
+            yield f
+        elif os.path.isdir(filename) and not os.path.islink(filename):
+            for child in find_ignored(path, ignore, f):
+                yield child
+
+# Give destination the mode, times and owner of source
+def copy_ownership(source, destination):
+    shutil.copystat(source, destination)
+    st = os.stat(source)
+    try:
+        os.chown(destination, st.st_uid, st.st_gid)
+    except OSError:
+        pass # only root can give files away
+
+# Create the directory relpath of the tree at source in the tree at
+# destination, and the parent directories it needs, with the mode, times and
+# owner of the directories in source
+def copy_directories(source, destination, relpath):
+    if not relpath or os.path.isdir(os.path.join(destination, relpath)):
+        return
+    copy_directories(source, destination, os.path.dirname(relpath))
+    os.mkdir(os.path.join(destination, relpath))
+    copy_ownership(os.path.join(source, relpath), os.path.join(destination, relpath))
+
+# Move the ignored files of the tree at source into the tree at destination,
+# replacing the ignored files that destination has itself. Every ignored file or
+# directory is moved with a rename, so its owner stays the same and nothing
+# that is written to it is lost. If moving fails, the files that were moved
+# already are moved back. Returns the paths of the moved files.
+def move_ignored(source, destination, ignore):
+    for f in list(find_ignored(destination, ignore)):
+        if os.path.isdir(os.path.join(destination, f)) and not os.path.islink(os.path.join(destination, f)):
+            shutil.rmtree(os.path.join(destination, f))
+        else:
+            os.remove(os.path.join(destination, f))
+    moved = []
+    try:
+        for f in list(find_ignored(source, ignore)):
+            copy_directories(source, destination, os.path.dirname(f))
+            os.rename(os.path.join(source, f), os.path.join(destination, f))
+            moved.append(f)
+            count('files_touched')
+    except:
+        move_back(moved, destination, source)
+        raise
+    return moved
+
+# Move the files that move_ignored() moved from source to destination back
+def move_back(moved, destination, source):
+    for f in reversed(moved):
+        copy_directories(destination, source, os.path.dirname(f))
+        os.rename(os.path.join(destination, f), os.path.join(source, f))
+
+# Swap the tree at staging in as the tree of a package, keeping the current tree
+# as its 'old' tree. The ignored files of the current tree, like the sites
+# directory of Drupal core, are moved into the tree at staging first, and the
+# tree at staging gets the mode and owner of the current tree. The swap itself
+# is two renames, so the package is never a mix of two trees; it is only
+# missing between the two renames. If the swap fails, the current tree and its
+# ignored files are put back.
+def swap_package(package, staging):
+    old = get_staging_path(package, 'old')
+    if os.path.exists(old):
+        shutil.rmtree(old)
+    ensure_dir(os.path.dirname(old))
+    copy_ownership(package['location'], staging)
+    moved = move_ignored(package['location'], staging, get_ignore_matcher(package))
+    try:
+        os.rename(package['location'], old)
+        try:
+            os.rename(staging, package['location'])
+        except:
+            os.rename(old, package['location'])
+            raise
+    except:
+        move_back(moved, staging, package['location'])
+        raise
+    # the working directory moved along with the tree it was in
+    if package['location'] == package['drupal_root']:
+        os.chdir(package['drupal_root'])
+    print "Swapped the tree into place. The tree it replaced is kept in %s" % old
+
+# Swap the trees of the packages back to the trees that were kept by the last
+# staged update. The ignored files of the current trees, like the sites
+# directory of Drupal core, are kept. Rolling back again redoes the update.
+def rollback_packages(packages):
+    # contrib packages first, because they live inside the tree of Drupal core
+    for package in sorted(packages, key=lambda package: package['name'] == 'drupal'):
+        old = get_staging_path(package, 'old')
+        if not os.path.isdir(old):
+            continue
+        print "Rolling back %s" % package['name']
+        staging = prepare_staging(package)
+        if not staging:
+            continue
+        os.rename(old, staging)
+        swap_package(package, staging)
 
-                    # construct list of all dirs and files in downloaded package
-                    best_download_location = find_download_location(best_extract_dir)
-                    if not best_download_location:
-                        print "Extracting package not found. Skipping"
+# Read the output of the patch command. Returns a dict that maps every file it
+# patched to 'applied', 'fuzz' (applied, but with fuzz), 'already-applied',
+# 'rejected' (at least one hunk failed) or 'exists' (the patch creates the file,
+# but it is already there, so nothing was done).
+def parse_patch_output(output):
+    results = {}
+    f = None
+    for line in output.splitlines():
+        match = patch_file_re.match(line)
+        if match:
+            f = match.group(1) or match.group(2)
+            results[f] = 'applied'
+            continue
+        match = patch_exists_re.match(line)
+        if match:
+            results[match.group(1) or match.group(2)] = 'exists'
+            f = None
+        elif f is None:
+            continue
+        elif line.startswith('Reversed (or previously applied) patch detected'):
+            results[f] = 'already-applied'
+        elif patch_failed_re.match(line):
+            results[f] = 'rejected'
+        elif patch_fuzz_re.match(line) and results[f] == 'applied':
+            results[f] = 'fuzz'
+    return results
+
+# Apply a patch, which may change multiple files, to location with a single
+# patch command. Patches that were applied before are skipped, and no backup
+# files are left behind. Returns the results of parse_patch_output() and the
+# output itself.
+def apply_patch(patch, location):
+    with stage('patch'):
+        count('subprocesses')
+        process = subprocess.Popen(['patch', '-t', '-N', '-p0', '--no-backup-if-mismatch'], stdin = subprocess.PIPE, stdout = subprocess.PIPE, stderr = subprocess.STDOUT, cwd = location)
+        output = process.communicate(patch)[0]
+    results = parse_patch_output(output)
+    count('files_touched', len(results))
+    return results, output
+
+# The patch store of a package is the directory patches_path/drupal for Drupal
+# core, and the location of the package relative to the Drupal root for contrib
+# packages, because the same project can be installed in multiple places. Its
+# manifest.json records the version the changes were captured against, and for
+# every changed file the change ('modified', 'added' or 'removed'), the type
+# ('text', 'binary' or 'directory') and the md5 hash of the installed file. The
+# diffs of the text files are stored one after the other in changes.patch.gz,
+# the manifest has the offset and length of each. Binary files are stored in
+# blobs/ by their md5 hash.
+def get_patch_store_path(patches_path, package):
+    relpath = os.path.relpath(package['location'], package['drupal_root'])
+    return os.path.join(patches_path, package['name'] if relpath == '.' else relpath)
+
+def get_patch_blob_path(patches_path, package, md5):
+    return os.path.join(get_patch_store_path(patches_path, package), 'blobs', md5)
+
+# Read the patch store of a package. Returns the manifest and the diffs, or None
+# and an empty string if there is no (readable) store.
+def load_patch_store(patches_path, package):
+    path = get_patch_store_path(patches_path, package)
+    try:
+        with open(os.path.join(path, 'manifest.json')) as fp:
+            manifest = json.load(fp)
+        with open(os.path.join(path, 'changes.patch.gz'), 'rb') as fp:
+            diffs = zlib.decompress(fp.read(), 16 + zlib.MAX_WBITS)
+    except (IOError, ValueError, zlib.error):
+        return None, ''
+    return manifest, diffs
+
+# Write the manifest and the diffs of a package to its patch store, and remove
+# the binary files the manifest no longer refers to. No other package uses the
+# store, so no other manifest refers to them either.
+def save_patch_store(patches_path, package, manifest, diffs):
+    path = get_patch_store_path(patches_path, package)
+    compressor = zlib.compressobj(9, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    write_file_atomic(os.path.join(path, 'changes.patch.gz'), compressor.compress(diffs) + compressor.flush())
+    write_file_atomic(os.path.join(path, 'manifest.json'), json.dumps(manifest, indent=2, sort_keys=True, separators=(',', ': ')) + '\n')
+
+    blobs = set([ entry['md5'] for entry in manifest['files'].values() if entry['type'] == 'binary' and entry.has_key('md5') ])
+    if os.path.isdir(os.path.join(path, 'blobs')):
+        for md5 in os.listdir(os.path.join(path, 'blobs')):
+            if md5 not in blobs:
+                os.remove(os.path.join(path, 'blobs', md5))
+
+# Copy a binary file into the patch store of a package, unless it is there
+# already
+def store_patch_blob(patches_path, package, md5, filename):
+    blob = get_patch_blob_path(patches_path, package, md5)
+    if not os.path.isfile(blob):
+        with open(filename, 'rb') as fp:
+            write_file_atomic(blob, fp.read())
+
+# Update a single package to package['best_version'], recording the changes
+# that are found in the patch store in patches_path and reapplying them
+# afterwards. Files for which a
+# patch could not be reapplied are listed in package['patch_failures'], and
+# package['patch_results'] has the result of every reapplied patch, see
+# apply_patch().
+# Returns False if the package was skipped.
+def update_package(package, patches_path):
+    print "\nStart analysing %s" % package['name']
+    package['patch_failures'] = []
+    package['patch_results'] = {}
+
+    ignore = get_ignore_matcher(package)
+
+    # download the package from the version that we use, and compare it with the
+    # installed package. Only the files that differ are extracted.
+    with tempdir() as extract_dir:
+        with stage('compare'):
+            comparison = compare_package(package, extract_dir, ignore)
+        if not comparison:
+            return False
+        download_location = comparison['download_location']
+        downloaded_entries = comparison['downloaded_entries']
+        original_filelist = comparison['original_filelist']
+        original_entries = comparison['original_entries']
+
+        for f in comparison['matching_files']:
+            if downloaded_entries[f].kind != original_entries[f].kind:
+                print 'Problem with %s. Only one is a directory. Skipping' % f
+
+        # record the changes to the installed package in the patch store. Diffs
+        # of files that did not change since the store was written are reused.
+        previous, previous_diffs = load_patch_store(patches_path, package)
+        if previous and previous.get('base_version') != package['version']:
+            previous = None
+        manifest = {
+            'name': package['name'],
+            'base_version': package['version'],
+            'files': {},
+        }
+        diffs = []
+        diffs_size = 0
+        for change in describe_changes(package, comparison):
+            f = change['path']
+            entry = {'change': change['change'], 'type': change['type']}
+            if change['type'] == 'directory':
+                print "Directory %s %s. Recorded in the patch store." % (f, change['change'])
+            elif change['change'] == 'removed':
+                print "Removed %s file %s. Recorded in the patch store." % (change['type'], f)
+            elif change['type'] == 'binary':
+                entry['md5'] = md5_for_file(os.path.join(package['location'], f)).encode('hex')
+                store_patch_blob(patches_path, package, entry['md5'], os.path.join(package['location'], f))
+                print "%s binary file %s. Copied to the patch store." % ('Diff in' if change['change'] == 'modified' else 'Added', f)
+            else:
+                entry['md5'] = md5_for_file(os.path.join(package['location'], f)).encode('hex')
+                previous_entry = previous['files'].get(f) if previous else None
+                if previous_entry and previous_entry.get('md5') == entry['md5'] and previous_entry['change'] == entry['change'] and previous_entry.get('patch'):
+                    offset, length = previous_entry['patch']
+                    output = previous_diffs[offset:offset + length]
+                    print "%s text file %s. Patch unchanged since the last run." % ('Diff in' if change['change'] == 'modified' else 'Added', f)
+                else:
+                    with stage('diff'):
+                        output = diff_files(f, download_location, package['location'])
+                    if not output:
                         continue
-                    best_downloaded_filelist = construct_filelist(best_download_location, ignore_list)
+                    print "%s text file %s. Stored patch in the patch store." % ('Diff in' if change['change'] == 'modified' else 'Added', f)
+                entry['patch'] = [diffs_size, len(output)]
+                diffs.append(output)
+                diffs_size += len(output)
+            manifest['files'][f] = entry
+        diffs = ''.join(diffs)
+        if manifest['files']:
+            save_patch_store(patches_path, package, manifest, diffs)
+
+        print "Updating package"
+
+        # in staged mode the new tree is built next to the live one, and swapped
+        # in when it is complete. Otherwise the live tree is changed file by file.
+        staging = None
+        if staged:
+            staging = prepare_staging(package)
+            if not staging:
+                return False
 
+        # download and extract the package from the best version
+        with tempdir(os.path.dirname(staging) if staging else None) as best_extract_dir:
+            if shared_release_dir:
+                best_download_location = get_shared_release(package, package['best_version'])
+                if not best_download_location:
+                    print "Extracting package failed. Skipping"
+                    return False
+            else:
+                if not extract_package(package, package['best_version'], best_extract_dir, ignore):
+                    print "Extracting package failed. Skipping"
+                    return False
+
+                # construct list of all dirs and files in downloaded package
+                best_download_location = find_download_location(best_extract_dir)
+                if not best_download_location:
+                    print "Extracting package not found. Skipping"
+                    return False
+
+            if staging:
+                # the extracted package becomes the new tree, the ignored files
+                # of the live tree are moved into it by swap_package(). A
+                # shared release is copied, because other installations use it
+                # too.
+                with stage('copy'):
+                    if shared_release_dir:
+                        copy_tree(best_download_location, staging, ignore)
+                    else:
+                        os.rename(best_download_location, staging)
+                target = staging
+            else:
+                target = package['location']
+                with stage('filelist'):
+                    best_downloaded_filelist = list(construct_filelist(best_download_location, ignore))
+                best_kinds = dict([ (entry.path, entry.kind) for entry in best_downloaded_filelist ])
+
+                with stage('copy'):
                     # check if we need to remove files or directories
-                    for f in original_filelist:
-                        if os.path.isdir(os.path.join(package['location'], f)) and not os.path.isdir(os.path.join(best_download_location, f)):
+                    removed_directory = None
+                    for entry in original_filelist:
+                        f = entry.path
+                        if removed_directory and f.startswith(removed_directory + '/'):
+                            continue # already removed with its directory
+                        if entry.kind == 'directory' and best_kinds.get(f) != 'directory':
+                            # a directory that holds ignored files, like the
+                            # contrib packages of a profile, is kept
+                            if any(find_ignored(package['location'], ignore, f)):
+                                continue
                             shutil.rmtree(os.path.join(package['location'], f))
+                            count('files_touched')
+                            removed_directory = f
                             print "Directory %s removed" % f
-                        if os.path.isfile(os.path.join(package['location'], f)) and not os.path.isfile(os.path.join(best_download_location, f)):
+                        if entry.kind == 'file' and best_kinds.get(f) != 'file':
                             os.remove(os.path.join(package['location'], f))
+                            count('files_touched')
                             print "File %s removed" % f
 
                     # copy new files and directories into the project
-                    for f in best_downloaded_filelist:
-                        if os.path.isdir(os.path.join(best_download_location, f)):
-                            if not os.path.isdir(os.path.join(package['location'], f)):
+                    for entry in best_downloaded_filelist:
+                        f = entry.path
+                        if entry.kind == 'directory':
+                            if f not in original_entries or original_entries[f].kind != 'directory':
                                 os.makedirs(os.path.join(package['location'], f))
                         else:
                             shutil.copyfile(os.path.join(best_download_location, f), os.path.join(package['location'], f))
+                            count('files_touched')
 
-                    # loop over the files that we have in both tree
-                    for f in matching_files:
-                        if os.path.isfile(os.path.join(patches_path, package['name'], f)) and is_binary(os.path.join(patches_path, package['name'], f)):
-                            shutil.copyfile(os.path.join(patches_path, package['name'], f), os.path.join(package['location'], f))
-                            print "Copied changed binary file %s back into the project" % f
-                        if os.path.isfile(os.path.join(patches_path, package['name'], f + '.patch')):
-                            with workingdir(package['location']):
-                                with open(os.path.join(patches_path, package['name'], f + '.patch')) as fp:
-                                    try:
-                                        output = subprocess.check_output(['patch', '-f', '-p0'], stderr = subprocess.STDOUT, stdin = fp)
-                                        print output
-                                    except subprocess.CalledProcessError as e:
-                                        print e.output
-                    for f in added_files:
-                        if os.path.isfile(os.path.join(patches_path, package['name'], f)) and is_binary(os.path.join(patches_path, package['name'], f)):
-                            if not os.path.isdir(os.path.dirname(os.path.join(package['location'], f))):
-                                os.makedirs(os.path.dirname(os.path.join(package['location'], f)))
-                            shutil.copyfile(os.path.join(patches_path, package['name'], f), os.path.join(package['location'], f))
-                            print "Copied added binary file %s back into the project" % f
-                        if os.path.isfile(os.path.join(patches_path, package['name'], f + '.patch')):
-                            with workingdir(package['location']):
-                                with open(os.path.join(patches_path, package['name'], f + '.patch')) as fp:
-                                    try:
-                                        output = subprocess.check_output(['patch', '-f', '-p0'], stderr = subprocess.STDOUT, stdin = fp)
-                                        print output
-                                    except subprocess.CalledProcessError as e:
-                                        print e.output
-                    for f in removed_files:
-                        if os.path.isdir(os.path.join(package['location'], f)):
-                            shutil.rmtree(os.path.join(package['location'], f))
-                            print "Removed directory %s" % f
-                        elif os.path.isfile(os.path.join(package['location'], f)):
-                            os.remove(os.path.join(package['location'], f))
-                            print "Removed file %s" % f
+            # apply the recorded changes to the new tree: binary files are copied
+            # back, removed files are removed again and the patches of all text
+            # files are combined and applied at once
+            patch_files = []
+            combined_patch = ''
+            for f in sorted(manifest['files'], key=path_sort_key):
+                entry = manifest['files'][f]
+                if entry['change'] == 'removed':
+                    if os.path.isdir(os.path.join(target, f)):
+                        shutil.rmtree(os.path.join(target, f))
+                        print "Removed directory %s" % f
+                    elif os.path.isfile(os.path.join(target, f)):
+                        os.remove(os.path.join(target, f))
+                        print "Removed file %s" % f
+                elif entry['type'] == 'directory':
+                    ensure_dir(os.path.join(target, f))
+                elif entry['type'] == 'binary':
+                    ensure_dir(os.path.dirname(os.path.join(target, f)))
+                    shutil.copyfile(get_patch_blob_path(patches_path, package, entry['md5']), os.path.join(target, f))
+                    count('files_touched')
+                    print "Copied %s binary file %s back into the project" % ('changed' if entry['change'] == 'modified' else 'added', f)
+                else:
+                    offset, length = entry['patch']
+                    combined_patch += diffs[offset:offset + length]
+                    patch_files.append(f)
+
+            if patch_files:
+                results, output = apply_patch(combined_patch, target)
+                for f in patch_files:
+                    result = results.get(f, 'rejected')
+                    # an added file that the new version has as well
+                    if result == 'exists' and md5_for_file(os.path.join(target, f)).encode('hex') == manifest['files'][f]['md5']:
+                        result = 'already-applied'
+                    package['patch_results'][f] = 'rejected' if result == 'exists' else result
+                    if result == 'applied':
+                        print "Reapplied patch to %s" % f
+                    elif result == 'fuzz':
+                        print "Reapplied patch to %s with fuzz. Check the result" % f
+                    elif result == 'already-applied':
+                        # patch saves the hunks it skipped as reversed as well
+                        if os.path.isfile(os.path.join(target, f + '.rej')):
+                            os.remove(os.path.join(target, f + '.rej'))
+                        print "Patch to %s was already applied. Skipped it" % f
+                    elif result == 'exists':
+                        print "Reapplying patch to %s failed. The new version has a different file with that name" % f
+                        package['patch_failures'].append(f)
+                    else:
+                        print "Reapplying patch to %s failed. Rejected hunks are in %s.rej" % (f, f)
+                        package['patch_failures'].append(f)
+                if len(results) < len(patch_files):
+                    print output
+
+        if staging:
+            swap_package(package, staging)
+
+    return True
+
+# Update a package and record the outcome in package['status']: 'updated',
+# 'skipped' or 'failed'. An exception only fails the package it happened in.
+def run_update(package, patches_path):
+    try:
+        with stage('update', package):
+            updated = update_package(package, patches_path)
+        if updated:
+            package['status'] = 'updated'
+        else:
+            package['status'] = 'skipped'
+    except Exception:
+        traceback.print_exc(file=sys.stdout)
+        package['status'] = 'failed'
+
+# Update the packages, running the contrib packages in `workers` threads. Drupal
+# core is updated on its own first, because the contrib packages live inside
+# its tree. The output of every package is kept together.
+def update_packages(packages, patches_path, workers=1):
+    core = [ package for package in packages if package['name'] == 'drupal' ]
+    contrib = [ package for package in packages if package['name'] != 'drupal' ]
+
+    for package in core:
+        run_update(package, patches_path)
+    if workers <= 1:
+        for package in contrib:
+            run_update(package, patches_path)
+        return
+
+    def worker(package):
+        sys.stdout.capture()
+        try:
+            run_update(package, patches_path)
+        finally:
+            sys.stdout.release()
+
+    stdout = sys.stdout
+    sys.stdout = ThreadOutput(stdout)
+    try:
+        run_in_threads(worker, contrib, workers)
+    finally:
+        sys.stdout = stdout
+
+# Read the Drupal installations of a batch from a file, or from stdin for -.
+# Every line has the Drupal root and the patch directory, which is relative to
+# the Drupal root, separated by whitespace. Empty lines and lines starting with
+# # are skipped.
+def read_batch_file(filename):
+    if filename == '-':
+        lines = sys.stdin.read().splitlines()
+    else:
+        with open(filename) as fp:
+            lines = fp.read().splitlines()
+
+    sites = []
+    for line in lines:
+        line = line.strip()
+        if not line or line.startswith('#'):
+            continue
+        parts = line.split(None, 1)
+        if len(parts) != 2:
+            print "No patch directory for %s in the batch file" % parts[0]
+            sys.exit()
+        sites.append((os.path.abspath(parts[0]), parts[1]))
+    return sites
+
+# Update multiple Drupal installations without asking anything. Discovery,
+# release history lookups and downloads are shared: every release is looked up
+# once, and downloaded and extracted once, for all installations.
+def run_batch(sites, concurrency=default_concurrency, workers=1):
+    global shared_release_dir
+
+    installations = []
+    for drupal_root, patches_path in sites:
+        if not os.path.isfile(os.path.join(drupal_root, 'modules/system/system.info')):
+            print "%s is not a Drupal installation. Skipping" % drupal_root
+            continue
+        with stage('discovery'):
+            packages = find_packages(drupal_root)
+        if not packages:
+            print "System of %s not recognized as package. Skipping" % drupal_root
+            continue
+        installations.append((drupal_root, patches_path, packages))
+
+    all_packages = [ package for drupal_root, patches_path, packages in installations for package in packages ]
+    print "\nLooking up the best versions of %d packages in %d installations" % (len(all_packages), len(installations))
+    lookup_best_versions(all_packages, concurrency)
+
+    with tempdir() as shared_release_dir:
+        try:
+            for drupal_root, patches_path, packages in installations:
+                print "\nUpdating %s" % drupal_root
+                patches_path = ensure_patches_path(os.path.join(drupal_root, patches_path))
+                outdated = report_best_versions(packages)
+                if staged and outdated:
+                    clear_old_trees(drupal_root)
+                update_packages(outdated, patches_path, workers)
+                print_summary(outdated)
+        finally:
+            shared_release_dir = None
+
+# Print what happened to the packages that needed an update
+def print_summary(packages):
+    print "\nSummary"
+    for status in ['updated', 'skipped', 'failed']:
+        names = [ '%s (%s -> %s)' % (package['name'], package['version'], package['best_version']) for package in packages if package.get('status') == status ]
+        print "%s: %d" % (status.capitalize(), len(names))
+        for name in names:
+            print "    %s" % name
+    for package in packages:
+        if package.get('patch_failures'):
+            print "Patches of %s that failed to apply:" % package['name']
+            for f in package['patch_failures']:
+                print "    %s" % f
+        fuzz = sorted([ f for f, result in package.get('patch_results', {}).items() if result == 'fuzz' ])
+        if fuzz:
+            print "Patches of %s that applied with fuzz:" % package['name']
+            for f in fuzz:
+                print "    %s" % f
+
+# Estimate the number of bytes an update of a package downloads: the tarballs
+# of the installed and the best version, unless they are in the cache
+def estimate_download_bytes(package):
+    total = 0
+    for version in [package['version'], package['best_version']]:
+        release = package.get('releases', {}).get(version, {})
+        if cache_dir and cache_lookup(package['name'], version, release.get('md5')):
+            continue
+        try:
+            total += int(release.get('filesize') or 0)
+        except ValueError:
+            pass
+    return total
+
+# List the patches an update of a package would capture, based on the result of
+# compare_package()
+def describe_changes(package, comparison):
+    download_location = comparison['download_location']
+    changes = []
+    for f in comparison['matching_files']:
+        if comparison['downloaded_members'][f] != 'different' or comparison['original_entries'][f].kind == 'directory':
+            continue
+        kind = 'binary' if is_binary(os.path.join(package['location'], f)) else 'text'
+        changes.append({'path': f, 'change': 'modified', 'type': kind})
+    for f in comparison['added_files']:
+        if comparison['original_entries'][f].kind == 'directory':
+            kind = 'directory'
+        else:
+            kind = 'binary' if is_binary(os.path.join(package['location'], f)) else 'text'
+        changes.append({'path': f, 'change': 'added', 'type': kind})
+    for f in comparison['removed_files']:
+        if comparison['downloaded_entries'][f].kind == 'directory':
+            kind = 'directory'
+        else:
+            kind = 'binary' if is_binary(os.path.join(download_location, f)) else 'text'
+        changes.append({'path': f, 'change': 'removed', 'type': kind})
+    return changes
+
+# Construct the plan of a package: the versions involved, the bytes to download
+# and, if verify is set, the files that differ from the release and the patches
+# an update would capture. Nothing in the installation is changed.
+def plan_package(package, verify=False):
+    plan = {
+        'name': package['name'],
+        'location': package['location'],
+        'version': package['version'],
+        'best_version': package.get('best_version'),
+    }
+    if package.has_key('error'):
+        plan['status'] = 'error'
+        plan['error'] = package['error']
+        return plan
+    if not package.get('best_version'):
+        plan['status'] = 'no release'
+        return plan
+    if package['version'] == package['best_version']:
+        plan['status'] = 'up to date'
+        return plan
+
+    plan['status'] = 'outdated'
+    plan['download_bytes'] = estimate_download_bytes(package)
+    if verify:
+        with tempdir() as extract_dir:
+            with stage('compare', package):
+                comparison = compare_package(package, extract_dir, get_ignore_matcher(package))
+            if comparison:
+                plan['patches'] = describe_changes(package, comparison)
+                plan['differing_files'] = sorted([ change['path'] for change in plan['patches'] if change['type'] != 'directory' ])
+            else:
+                plan['status'] = 'error'
+                plan['error'] = 'comparing with the release failed'
+    return plan
+
+# Construct the plan for a Drupal installation, see plan_package(). The
+# packages are verified in `workers` threads.
+def plan_packages(drupal_root, packages, verify=False, workers=1):
+    plans = {}
+    def worker(package):
+        try:
+            plans[id(package)] = plan_package(package, verify)
+        except Exception as e:
+            # exceptions do not leave the thread, so keep it in the plan
+            plans[id(package)] = {
+                'name': package['name'],
+                'location': package['location'],
+                'version': package['version'],
+                'best_version': package.get('best_version'),
+                'status': 'error',
+                'error': str(e),
+            }
+    run_in_threads(worker, packages, workers)
+
+    plans = [ plans[id(package)] for package in packages ]
+    return {
+        'drupal_root': drupal_root,
+        'created': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+        'download_bytes': sum([ plan.get('download_bytes', 0) for plan in plans ]),
+        'packages': plans,
+    }
+
+def main():
+    global drupal_download_base, drupal_release_info_base, http_timeout, http_retries, http_connections, http_slots, http_bandwidth, cache_dir, cache_size, cache_max_age, offline, release_history_ttl, diff_backend, discovery_prune, ignore_file, staged
+
+    parser = argparse.ArgumentParser(description='Updates Drupal projects to the newest version.')
+    parser.add_argument('--concurrency', type=int, default=default_concurrency,
+        help='number of release history lookups to run at the same time (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=1,
+        help='number of packages to update at the same time (default: %(default)s)')
+    parser.add_argument('--release-history-url', default=drupal_release_info_base,
+        help='base url of the release history service (default: %(default)s)')
+    parser.add_argument('--download-url', default=drupal_download_base,
+        help='base url to download packages from (default: %(default)s)')
+    parser.add_argument('--http-timeout', type=int, default=default_http_timeout,
+        help='seconds before connecting to or reading from a server times out (default: %(default)s)')
+    parser.add_argument('--http-retries', type=int, default=default_http_retries,
+        help='number of times a failed download is retried (default: %(default)s)')
+    parser.add_argument('--http-connections', type=int, default=default_http_connections,
+        help='number of downloads at the same time (default: %(default)s)')
+    parser.add_argument('--bandwidth', type=int, default=0,
+        help='kilobytes per second that all downloads together may use (default: unlimited)')
+    parser.add_argument('--cache-dir', default=default_cache_dir,
+        help='directory to cache downloads and release histories in (default: %(default)s)')
+    parser.add_argument('--no-cache', action='store_true',
+        help='do not use the cache')
+    parser.add_argument('--cache-size', type=int, default=default_cache_size,
+        help='maximum size of the download cache in megabytes (default: %(default)s)')
+    parser.add_argument('--cache-max-age', type=int, default=default_cache_max_age,
+        help='remove cached downloads that were not used for this many days (default: %(default)s)')
+    parser.add_argument('--offline', action='store_true',
+        help='only use packages and release histories that are in the cache')
+    parser.add_argument('--release-history-ttl', type=int, default=default_release_history_ttl,
+        help='use cached release histories younger than this many seconds without checking for changes (default: %(default)s)')
+    parser.add_argument('--prune', action='append', default=[], metavar='NAME',
+        help='do not search directories with this name for packages, in addition to %s' % ', '.join(default_discovery_prune))
+    parser.add_argument('--ignore-file', metavar='FILE',
+        help='read the patterns of files to ignore from FILE instead of %s in the Drupal root' % ignore_filename)
+    parser.add_argument('--staged', action='store_true',
+        help='build the updated packages next to the live ones and swap them in when they are complete')
+    parser.add_argument('--rollback', action='store_true',
+        help='swap back the packages that were changed by the last staged update')
+    parser.add_argument('--patches', metavar='DIR',
+        help='put the patch files in DIR, relative to the Drupal root, instead of asking for it')
+    parser.add_argument('--batch', metavar='FILE',
+        help='update the Drupal installations listed in FILE, or stdin for -, without asking anything. Every line has a Drupal root and a patch directory. Cannot be combined with --plan or --rollback')
+    parser.add_argument('--plan', metavar='FILE',
+        help='do not update anything, but write a JSON plan of the update to FILE, or to stdout for -')
+    parser.add_argument('--plan-verify', action='store_true',
+        help='compare the installed packages with their release for the plan')
+    parser.add_argument('--diff-backend', choices=diff_backends, default=diff_backend,
+        help='construct patches in-process or with the external diff command (default: %(default)s)')
+    parser.add_argument('--report', metavar='FILE',
+        help='write the time, bytes, subprocesses and files of every stage and package to FILE as JSON')
+    parser.add_argument('--trace', metavar='FILE',
+        help='write the stages to FILE in the trace event format, for chrome://tracing')
+    parser.add_argument('--profile', metavar='FILE',
+        help='profile the main thread with cProfile and write the statistics to FILE')
+    options = parser.parse_args()
+    if options.batch and (options.plan or options.rollback):
+        parser.error('--batch cannot be combined with --plan or --rollback')
+    if options.plan and options.rollback:
+        parser.error('--plan cannot be combined with --rollback')
+
+    drupal_release_info_base = options.release_history_url
+    http_timeout = options.http_timeout
+    http_retries = options.http_retries
+    http_connections = options.http_connections
+    http_slots = threading.BoundedSemaphore(http_connections)
+    http_bandwidth = options.bandwidth * 1024
+    drupal_download_base = options.download_url
+    cache_dir = None if options.no_cache else options.cache_dir
+    cache_size = options.cache_size
+    cache_max_age = options.cache_max_age
+    offline = options.offline
+    release_history_ttl = options.release_history_ttl
+    diff_backend = options.diff_backend
+    discovery_prune = default_discovery_prune + options.prune
+    ignore_file = options.ignore_file
+    staged = options.staged
+    if offline and not cache_dir:
+        print "Offline mode needs the download cache"
+        sys.exit()
+
+    if options.report or options.trace or options.profile:
+        start_instrumentation(options.profile)
+    try:
+        run(options)
+    finally:
+        close_http_connections()
+        if instrumentation is not None:
+            stop_instrumentation(options.report, options.trace, options.profile)
+
+# Run the updater with the options of main()
+def run(options):
+    if options.batch:
+        run_batch(read_batch_file(options.batch), options.concurrency, options.workers)
+        return
+
+    # Make sure we are in a Drupal directory
+    drupal_root = os.getcwd()
+    if not os.path.isfile(os.path.join(drupal_root, 'modules/system/system.info')):
+        print "Not in Drupal"
+        sys.exit()
+
+    # When planning, the plan is the only thing that is written to stdout
+    stdout = sys.stdout
+    if options.plan == '-':
+        sys.stdout = sys.stderr
+
+    if options.rollback:
+        packages = find_packages(drupal_root)
+        if packages:
+            rollback_packages(packages)
+        return
+
+    # Get a directory to put the patches in
+    if not options.plan and options.patches:
+        patches_path = ensure_patches_path(os.path.join(drupal_root, options.patches))
+    elif not options.plan:
+        patches_path = ask_patches_path(drupal_root)
+
+    # Find the packages in the system
+    with stage('discovery'):
+        packages = find_packages(drupal_root)
+    if not packages:
+        print "Something went wrong. System not recognized as package?"
+        sys.exit()
+
+    # find out which packages need to be updated before touching anything
+    print "\nLooking up the best versions of %d packages" % len(packages)
+    outdated = prefetch_best_versions(packages, options.concurrency)
+
+    if options.plan:
+        plan = plan_packages(drupal_root, packages, options.plan_verify, options.workers)
+        if options.plan == '-':
+            json.dump(plan, stdout, indent=2, sort_keys=True, separators=(',', ': '))
+            stdout.write('\n')
+        else:
+            with open(options.plan, 'w') as fp:
+                json.dump(plan, fp, indent=2, sort_keys=True, separators=(',', ': '))
+            print "Plan written to %s" % options.plan
+        return
+
+    # update the packages that need to be updated
+    if staged and outdated:
+        clear_old_trees(drupal_root)
+    update_packages(outdated, patches_path, options.workers)
+    print_summary(outdated)
+
+if __name__ == '__main__':
+    main()